@@ -8,14 +8,21 @@ with a C-based IntervalTree for accelerating the computation.
 '''
 
 import os
+import io
 import gzip
 import shutil
+import hashlib
+import re
+import tempfile
+import bisect
 import urllib
 import urllib.request
 from kerneltree import IntervalTree
 
 urlretrieve = urllib.request.urlretrieve
 
+_CHAIN_HEADER = re.compile(rb'^chain[ \t]+\S+[ \t]+(\S+)', re.M)
+
 def open_liftover_chain_file(from_db, to_db, search_dir='.', cache_dir=os.path.expanduser("~/.pyliftover"),
     use_web=True, write_cache=True):
     '''
@@ -80,6 +87,182 @@ def open_liftover_chain_file(from_db, to_db, search_dir='.', cache_dir=os.path.e
     return None
 
 
+def _composed_cache_name(chain_files):
+    '''
+    Returns the file name under which the composition of the given chain files
+    is cached. The name encodes the chain files being composed, together with their
+    sizes and modification times, so that a stale cache is never picked up.
+    '''
+    stems = []
+    md5 = hashlib.md5()
+    for f in chain_files:
+        path = f if isinstance(f, str) else getattr(f, 'name', '')
+        if isinstance(path, bytes):
+            path = path.decode()
+        stem = os.path.basename(path)
+        for ext in ['.gz', '.chain', '.over']:
+            if stem.endswith(ext):
+                stem = stem[:-len(ext)]
+        stems.append(stem)
+        md5.update(os.path.abspath(path).encode())
+        if os.path.isfile(path):
+            st = os.stat(path)
+            md5.update('{0}:{1}'.format(st.st_size, int(st.st_mtime)).encode())
+
+    return '{0}.{1}.over.chain.gz'.format('+'.join(stems), md5.hexdigest()[:8])
+
+def open_composed_chain_file(chain_files, cache_dir=os.path.expanduser("~/.pyliftover"), write_cache=True):
+    '''
+    Composes a series of liftover chain files (A->B, B->C, ...) into a single
+    chain file (A->C) and opens it for reading.
+
+    Each element of *chain_files* may be a file name (gzip-compressed if it ends
+    with .gz) or a file object open for reading in binary mode. The composed chains
+    are written to <cache_dir> and re-used by later calls with the same input files,
+    so the (relatively expensive) composition only happens once.
+
+    '''
+    cache_name = _composed_cache_name(chain_files)
+    if cache_dir is not None:
+        FILE_GZ = os.path.join(cache_dir, cache_name)
+        if os.path.isfile(FILE_GZ):
+            for f in chain_files:
+                if not isinstance(f, str):
+                    f.close()
+            return gzip.open(FILE_GZ, 'rb')
+
+    indexes = []
+    for f in chain_files:
+        if isinstance(f, str):
+            f = gzip.open(f, 'rb') if f.lower().endswith('.gz') else open(f, 'rb')
+        indexes.append(LiftOverChainFile(f))
+        f.close()
+
+    chains = indexes[0].chains
+    for i in range(1, len(indexes)):
+        chains = compose_chains(chains, indexes[i])
+
+    if write_cache and (cache_dir is not None):
+        try:
+            if not os.path.isdir(cache_dir):
+                os.mkdir(cache_dir)
+            # an interrupted write must not leave a truncated file under the cache name
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=cache_name + '.', suffix='.tmp.gz')
+            os.close(fd)
+            try:
+                write_liftover_chain_file(chains, tmp)
+                os.replace(tmp, FILE_GZ)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return gzip.open(FILE_GZ, 'rb')
+        except:
+            pass
+
+    return io.BytesIO(''.join(c.format() for c in chains).encode('ascii'))
+
+def _forward_position(position, source_from, target_from, chain):
+    '''
+    Maps a source position lying in the block starting at (source_from, target_from)
+    of *chain* to a 0-based position on the forward strand of the target chromosome.
+    '''
+    result = target_from + (position - source_from)
+    if chain.target_strand == '-':
+        result = chain.target_size - 1 - result
+
+    return result
+
+def compose_chains(chains, chain_file):
+    '''
+    Composes a list of LiftOverChain objects (A->B) with an indexed
+    LiftOverChainFile (B->C), and returns a list of LiftOverChain objects (A->C).
+
+    Every alignment block of the first chains is intersected with the blocks
+    of the second chain file overlapping its image in B; offsets and strands of
+    the two blocks are then composed. Pieces coming from the same pair of chains
+    are joined into one chain, whose score is the smaller of the two scores.
+    '''
+    pieces = {}
+    for i, c1 in enumerate(chains):
+        tree = chain_file.load(c1.target_name)
+        if tree is None:
+            continue
+        for (sfrom, sto, tfrom) in c1.blocks:
+            lo = _forward_position(sfrom, sfrom, tfrom, c1)
+            hi = _forward_position(sto - 1, sfrom, tfrom, c1)
+            lo, hi = min(lo, hi), max(lo, hi)
+            for (mfrom, mto, idx) in tree.search(lo, hi):
+                mtfrom, c2 = chain_file.data_by_index[idx]
+                # intersection of the two blocks on the forward strand of B (inclusive)
+                i0, i1 = max(lo, mfrom), min(hi, mto)
+                if i0 > i1:
+                    continue
+                if c1.target_strand == '+':
+                    x = sfrom + (i0 - tfrom)
+                else:
+                    x = sfrom + (c1.target_size - 1 - tfrom - i1)
+                size = i1 - i0 + 1
+                strand = '+' if c1.target_strand == c2.target_strand else '-'
+                pos = _forward_position(_forward_position(x, sfrom, tfrom, c1), mfrom, mtfrom, c2)
+                if strand == '-':
+                    pos = c2.target_size - 1 - pos
+                pieces.setdefault((i, id(c2)), (c1, c2, []))[2].append((x, x + size, pos))
+
+    composed = []
+    for c1, c2, blocks in pieces.values():
+        blocks.sort()
+        strand = '+' if c1.target_strand == c2.target_strand else '-'
+        current = [blocks[0]]
+        for (sfrom, sto, tfrom) in blocks[1:]:
+            psfrom, psto, ptfrom = current[-1]
+            ptto = ptfrom + (psto - psfrom)
+            if (sfrom == psto) and (tfrom == ptto):
+                current[-1] = (psfrom, sto, ptfrom)
+            elif (sfrom >= psto) and (tfrom >= ptto):
+                current.append((sfrom, sto, tfrom))
+            else:
+                composed.append(LiftOverChain.from_blocks(min(c1.score, c2.score), c1.source_name,
+                    c1.source_size, c2.target_name, c2.target_size, strand, current))
+                current = [(sfrom, sto, tfrom)]
+        composed.append(LiftOverChain.from_blocks(min(c1.score, c2.score), c1.source_name,
+            c1.source_size, c2.target_name, c2.target_size, strand, current))
+
+    composed.sort(key=lambda c: c.score, reverse=True)
+    for i, c in enumerate(composed):
+        c.id = str(i + 1)
+
+    return composed
+
+def write_liftover_chain_file(chains, path):
+    '''
+    Writes a list of LiftOverChain objects to *path* in the UCSC chain format.
+    The output is gzip-compressed if *path* ends with .gz.
+    '''
+    if path.lower().endswith('.gz'):
+        f = gzip.open(path, 'wt')
+    else:
+        f = open(path, 'w')
+    with f:
+        for c in chains:
+            f.write(c.format())
+
+
+def _parse_chains(data):
+    '''
+    Parses the chains in a chunk of a chain file (see
+    LiftOverChainFile.chain_data), e.g. in a worker process.
+    '''
+    stream = io.BytesIO(data)
+    chains = []
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        if line.startswith(b'chain'):
+            chains.append(LiftOverChain(line, stream))
+
+    return chains
+
 class LiftOverChainFile:
     '''
     The class loading and indexing USCS's chain files.
@@ -88,49 +271,119 @@ class LiftOverChainFile:
 
     '''
     
-    def __init__(self, f):
+    def __init__(self, f, chroms=None, lazy=False):
         '''
         Reads chain data from the file and initializes an interval index.
         f must be a file object open for reading.
         If any errors are detected, an Exception is thrown.
 
+        The file is scanned once for the byte offsets of the chain headers,
+        grouped by source chromosome. If *chroms* is given, only chains on these
+        source chromosomes are considered. If *lazy* is True, chains of a source
+        chromosome are only parsed and indexed the first time that chromosome
+        is queried (or :meth:`load` is called); otherwise everything is indexed
+        right away.
+
         '''
-        self.chains = self._load_chains(f)
-        self.chain_index, self.data_by_index = self._index_chains(self.chains)
-        
+        self.chains = []
+        self.chains_by_source = {}
+        self.chain_index = {}
+        self.data_by_index = []
+        self._target_size = {}
+        self._buffer = f.read()
+        self._bounds = None
+        self.offsets = self._index_offsets(self._buffer, chroms)
+        self._pending = set(self.offsets)
+        if not lazy:
+            self.load_all()
+
     @staticmethod
-    def _load_chains(f):
+    def _index_offsets(buffer, chroms=None):
+        '''
+        Returns a dict: source_name --> list of byte offsets of the
+        chain headers on that source chromosome.
+        '''
+        if not chroms is None:
+            chroms = set(chroms)
+        offsets = {}
+        for m in _CHAIN_HEADER.finditer(buffer):
+            source_name = m.group(1).decode('ascii')
+            if (chroms is None) or (source_name in chroms):
+                offsets.setdefault(source_name, []).append(m.start())
+
+        return offsets
+
+    def load(self, chromosome):
+        '''
+        Parses and indexes all chains on a source chromosome, if not done yet.
+        Returns the interval tree of the chromosome, or None if the chromosome
+        has no chains.
+        '''
+        if chromosome in self._pending:
+            self._register(chromosome, _parse_chains(self.chain_data(chromosome)))
+
+        return self.chain_index.get(chromosome)
+
+    def chain_data(self, chromosome):
+        '''
+        Returns the raw data of the chains on a source chromosome not indexed
+        yet (empty if there are none), e.g. to parse them in another process.
+        '''
+        if not chromosome in self._pending:
+            return b''
+        if self._bounds is None:
+            # a chain ends where the next chain header (on any chromosome) starts
+            self._bounds = [m.start() for m in _CHAIN_HEADER.finditer(self._buffer)] + [len(self._buffer)]
+        parts = []
+        for offset in self.offsets[chromosome]:
+            parts.append(self._buffer[offset:self._bounds[bisect.bisect_right(self._bounds, offset)]])
+
+        return b''.join(parts)
+
+    def chains_of(self, chromosome):
+        '''
+        Returns the chains on a source chromosome, without indexing them.
+        '''
+        if chromosome in self.chains_by_source:
+            return self.chains_by_source[chromosome]
+
+        return _parse_chains(self.chain_data(chromosome))
+
+    def load_all(self):
         '''
-        Loads all LiftOverChain objects from a file into an array.
+        Parses and indexes the chains of all source chromosomes not loaded yet.
         '''
-        chains = []
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            if line.startswith(b'#') or line.startswith(b'\n') or line.startswith(b'\r'):
-                continue
-            if line.startswith(b'chain'):
-                # Read chain
-                chains.append(LiftOverChain(line, f))
-                continue
+        for chrom in sorted(self._pending):
+            self.load(chrom)
 
-        return chains
+    def _register(self, chromosome, chains):
+
+        self._pending.remove(chromosome)
+        self.chains.extend(chains)
+        self.chains_by_source[chromosome] = chains
+        self._index_chains(chains, self.chain_index, self.data_by_index, self._target_size)
+        if not self._pending:
+            # everything is indexed, release the raw chain data
+            self._buffer = b''
+            self._bounds = None
 
     @staticmethod
-    def _index_chains(chains):
+    def _index_chains(chains, chain_index=None, data_by_index=None, target_size=None):
         '''
         Given a list of LiftOverChain objects, creates a
          dict: source_name --> 
             IntervalTree: <source_from, source_to> -->
                 (target_from, chain)
         Returns the resulting dict.
+
+        If an existing index (chain_index, data_by_index, and the target
+        chromosome sizes seen so far) is given, the chains are added to it.
         '''
-        chain_index = {}
-        data_by_index = []
+        chain_index = {} if chain_index is None else chain_index
+        data_by_index = [] if data_by_index is None else data_by_index
         source_size = {}
-        target_size = {}
-        idx = 0
+        target_size = {} if target_size is None else target_size
+        idx = len(data_by_index)
         for c in chains:
             # Verify that sizes of chromosomes are consistent over all chains
             source_size.setdefault(c.source_name, c.source_size)
@@ -159,10 +412,13 @@ class LiftOverChainFile:
         
         If chromosome is not found in the index, None is returned.
         '''
-        if chromosome not in self.chain_index:
-            return None
-        else:
-            return self.chain_index[chromosome].search(position, position)
+        tree = self.chain_index.get(chromosome)
+        if tree is None:
+            tree = self.load(chromosome)
+            if tree is None:
+                return None
+
+        return tree.search(position, position)
 
 
 class LiftOverChain:
@@ -177,6 +433,49 @@ class LiftOverChain:
                  'source_end', 'target_name', 'target_size', 'target_strand',
                  'target_start', 'target_end', 'id', 'blocks']
 
+    @classmethod
+    def from_blocks(cls, score, source_name, source_size, target_name, target_size, target_strand, blocks, id=None):
+        '''
+        Builds a chain directly from a list of (source_from, source_to, target_from)
+        blocks, sorted by source_from.
+        '''
+        self = cls.__new__(cls)
+        self.score = score
+        self.source_name = source_name
+        self.source_size = source_size
+        self.source_start = blocks[0][0]
+        self.source_end = blocks[-1][1]
+        self.target_name = target_name
+        self.target_size = target_size
+        self.target_strand = target_strand
+        self.target_start = blocks[0][2]
+        self.target_end = blocks[-1][2] + (blocks[-1][1] - blocks[-1][0])
+        self.id = id
+        self.blocks = list(blocks)
+
+        return self
+
+    def format(self):
+        '''
+        Returns the chain in the UCSC chain format, as a string ending with a blank line.
+        '''
+        fields = ['chain', str(self.score), self.source_name, str(self.source_size), '+',
+                  str(self.source_start), str(self.source_end), self.target_name,
+                  str(self.target_size), self.target_strand, str(self.target_start),
+                  str(self.target_end)]
+        if self.id is not None:
+            fields.append(str(self.id))
+        lines = [' '.join(fields)]
+        for i in range(len(self.blocks) - 1):
+            sfrom, sto, tfrom = self.blocks[i]
+            nsfrom, _, ntfrom = self.blocks[i+1]
+            size = sto - sfrom
+            lines.append('{0}\t{1}\t{2}'.format(size, nsfrom - sto, ntfrom - (tfrom + size)))
+        sfrom, sto, _ = self.blocks[-1]
+        lines.append(str(sto - sfrom))
+
+        return '\n'.join(lines) + '\n\n'
+
     def __init__(self, header, f):
         '''
         Reads the chain from a stream given the first line and
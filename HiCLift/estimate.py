@@ -0,0 +1,400 @@
+'''
+Sampling-based estimate of the resources of a HiCLift job ("--dry-run").
+
+A small random fraction of the input (BGZF blocks of a pairs file, tiles of a
+.hic file, or pixel chunks of a cooler) is run through the conversion
+functions used by HiCLift.utilities.liftover. The measured throughput, unique
+mapping rate, and size of the lifted pairs are then extrapolated to the full
+input.
+
+The sort and the generation of the output contact matrices (with the
+in-process writers) are timed on the lifted sample, and the memory and disk
+usage follow the selected intermediate. The matrix stage is split into a fixed
+cost, timed on a single contact, and a part that grows with the number of
+non-zero pixels, extrapolated from the sample. The bounded-window path for sorted pairs and the
+juicer_tools writer are not modelled; for them, a full sort is assumed and
+the matrix stage is left out.
+
+'''
+
+import os, io, gzip, zlib, time, math, struct, resource, subprocess, tempfile, shutil, logging
+import numpy as np
+import cooler
+from concurrent.futures import ThreadPoolExecutor
+from HiCLift.io import _pixel_to_reads, _pairs_write, _pairs_write_batch, hic_tiles, read_hic_file, MappableIndex, \
+    PAIRS_DTYPE, sort_binary_pairs
+from HiCLift.mcool import pairs_to_cool, zoomify
+from HiCLift.hic import write_hic_binary
+from HiCLift.utilities import load_liftover, get_chrom_order, get_header, is_sorted_pairs, extract_chrom_sizes, \
+    get_resolutions, parse_size, SORT_BUFFER
+
+log = logging.getLogger(__name__)
+
+def bgzf_blocks(path):
+    """
+    Returns the (offset, size) of all BGZF blocks of a file, or None if the
+    file is not BGZF-compressed. Only the block headers are read.
+    """
+    blocks = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            head = f.read(12)
+            if not len(head):
+                break
+            if (len(head) < 12) or (head[:2] != b'\x1f\x8b') or (not head[3] & 4):
+                return None
+            xlen = struct.unpack('<H', head[10:12])[0]
+            extra = f.read(xlen)
+            size = None
+            i = 0
+            while i + 4 <= len(extra):
+                slen = struct.unpack('<H', extra[i+2:i+4])[0]
+                if extra[i:i+2] == b'BC':
+                    size = struct.unpack('<H', extra[i+4:i+6])[0] + 1
+                    break
+                i += 4 + slen
+            if size is None:
+                return None
+            blocks.append((offset, size))
+            offset += size
+            f.seek(offset)
+
+    return blocks
+
+def sample_pairs(path, fraction, rng, chunksize=65536):
+    """
+    Sample lines of a pairs file. BGZF blocks (or chunks of an uncompressed
+    file) are picked at random, and the lines cut by chunk boundaries are
+    dropped. Returns the sampled lines and the ratio between the size of the
+    file and the size of the sampled chunks.
+    """
+    filesize = os.path.getsize(path)
+    if path.endswith('.gz'):
+        chunks = bgzf_blocks(path)
+        if chunks is None:
+            log.warning('{0} is not BGZF-compressed, only its beginning is sampled'.format(path))
+            lines = []
+            with open(path, 'rb') as raw:
+                with gzip.GzipFile(fileobj=raw) as f:
+                    for line in f:
+                        if not line.startswith(b'#'):
+                            lines.append(line.decode())
+                        if raw.tell() >= filesize * fraction:
+                            break
+                consumed = raw.tell()
+            return lines, filesize / max(consumed, 1)
+    else:
+        chunks = [(o, min(chunksize, filesize - o)) for o in range(0, filesize, chunksize)]
+
+    k = min(len(chunks), max(1, int(round(len(chunks) * fraction))))
+    picked = np.sort(rng.choice(len(chunks), size=k, replace=False))
+    lines = []
+    sampled_bytes = 0
+    with open(path, 'rb') as f:
+        for i in picked:
+            offset, size = chunks[i]
+            f.seek(offset)
+            data = f.read(size)
+            if path.endswith('.gz'):
+                data = zlib.decompressobj(31).decompress(data)
+            parts = data.decode('utf-8', 'replace').split('\n')
+            # the first and the last lines may be cut by the chunk boundaries
+            if i > 0:
+                parts = parts[1:]
+            parts = parts[:-1]
+            lines.extend(l + '\n' for l in parts if len(l) and not l.startswith('#'))
+            sampled_bytes += size
+
+    return lines, filesize / max(sampled_bytes, 1)
+
+def sample_hic(path, fraction, rng):
+    """
+    Sample pixels of a .hic file from tiles picked at random. Returns the
+    sampled pixels and the ratio between all tiles and sampled tiles.
+    """
+    _, tiles = hic_tiles(path)
+    k = min(len(tiles), max(1, int(round(len(tiles) * fraction))))
+    picked = np.sort(rng.choice(len(tiles), size=k, replace=False))
+    pixels = list(read_hic_file(path, tiles=[tiles[i] for i in picked]))
+
+    return pixels, len(tiles) / k
+
+def sample_cooler(path, fraction, rng, chunksize=100000):
+    """
+    Sample pixels of a cooler from chunks of its pixel table picked at random,
+    formatted as the lines of "cooler dump --join". Returns the sampled lines
+    and the ratio between all pixels and sampled pixels.
+    """
+    clr = cooler.Cooler(path)
+    nnz = int(clr.info['nnz'])
+    chunks = [(lo, min(lo + chunksize, nnz)) for lo in range(0, nnz, chunksize)]
+    if not len(chunks):
+        return [], 1
+    k = min(len(chunks), max(1, int(round(len(chunks) * fraction))))
+    picked = np.sort(rng.choice(len(chunks), size=k, replace=False))
+    lines = []
+    sampled = 0
+    for i in picked:
+        lo, hi = chunks[i]
+        pixels = clr.pixels(join=True)[lo:hi]
+        columns = [pixels[c].astype(str) for c in ['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2', 'count']]
+        lines.extend('\t'.join(row).encode() + b'\n' for row in zip(*columns))
+        sampled += hi - lo
+
+    return lines, nnz / sampled
+
+def _time_sort(data, tmpdir, nproc):
+
+    with tempfile.NamedTemporaryFile(dir=tmpdir, suffix='.pairs') as f:
+        f.write(data)
+        f.flush()
+        command = ['sort', '-k', '2,2', '-k', '4,4', '-k', '3,3n', '-k', '5,5n', '--stable',
+                   '--parallel={0}'.format(nproc), '-T', tmpdir, f.name]
+        start = time.time()
+        subprocess.check_call(command, stdout=subprocess.DEVNULL, env=dict(os.environ, LC_ALL='C'))
+
+        return time.time() - start
+
+def _binary_records(data, chrom_index):
+    """
+    Binary records (see HiCLift.io.PAIRS_DTYPE) of lifted pairs lines.
+    """
+    rows = [l.split('\t') for l in data.decode().splitlines()]
+    records = np.zeros(len(rows), dtype=PAIRS_DTYPE)
+    if len(rows):
+        records['chrom1'] = [chrom_index[r[1]] for r in rows]
+        records['pos1'] = [int(r[2]) for r in rows]
+        records['chrom2'] = [chrom_index[r[3]] for r in rows]
+        records['pos2'] = [int(r[4]) for r in rows]
+        records['strand1'] = [r[5] for r in rows]
+        records['strand2'] = [r[6].rstrip() for r in rows]
+
+    return records
+
+def _time_matrix(records, out_format, out_chroms, resolutions, assembly, balance_matrix, tmpdir, nproc):
+    """
+    Time the generation of the output contact matrices from sorted records.
+    """
+    chromsizes = extract_chrom_sizes(out_chroms)
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    blocks = [sort_binary_pairs(records)]
+    try:
+        start = time.time()
+        if out_format == 'cool':
+            outcool = os.path.join(workdir, 'sample.cool')
+            pairs_to_cool(blocks, outcool, chromsizes, resolutions[0], assembly=assembly, tmpdir=workdir)
+            zoomify(outcool, os.path.join(workdir, 'sample.mcool'), resolutions, nproc=nproc,
+                    balance_matrix=balance_matrix, tmpdir=workdir)
+        else:
+            write_hic_binary(blocks, os.path.join(workdir, 'sample.hic'), chromsizes, resolutions, genome=assembly,
+                             nproc=nproc)
+        return time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+
+def _expected_pixels(records, binsize, scale):
+    """
+    Number of non-zero pixels at *binsize* in the sampled records, and its
+    extrapolation to the full input. Pixels grow sub-linearly with contacts,
+    at a rate measured between half of the sample and the whole sample, and
+    never beyond the number of contacts or of pixels among the bins the
+    sample reaches (unmappable bins stay empty).
+    """
+    def nnz(r):
+        return np.unique(np.stack([r['chrom1'], r['chrom2'], r['pos1'] // binsize, r['pos2'] // binsize]), axis=1).shape[1]
+
+    sampled = nnz(records)
+    half = nnz(records[::2])
+    if (half < 1) or (sampled <= half):
+        rate = 0 if sampled <= half else 1
+    else:
+        rate = min(1, math.log(sampled / half) / math.log(len(records) / len(records[::2])))
+
+    nbins = np.unique(np.concatenate([records['chrom1'].astype(np.int64) << 32 | (records['pos1'] // binsize),
+                                      records['chrom2'].astype(np.int64) << 32 | (records['pos2'] // binsize)])).size
+    limit = min(len(records) * scale, nbins * (nbins + 1) // 2)
+
+    return sampled, int(min(sampled * scale ** rate, limit))
+
+def _input_header(path):
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt')
+    else:
+        f = open(path, 'r')
+    with f:
+        header, _ = get_header(f)
+
+    return header
+
+def _human(n):
+
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1024 or unit == 'TB':
+            return '{0:.1f} {1}'.format(n, unit)
+        n /= 1024.
+
+def _human_time(seconds):
+
+    seconds = int(round(seconds))
+
+    return '{0}h {1:02d}m {2:02d}s'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def dry_run(in_path, in_format, out_format, in_chroms, out_chroms, in_assembly, out_assembly,
+    chain_file, fraction=0.01, nproc=8, tmpdir='/tmp', memory='8G', via_assembly=None, intermediate='text',
+    seed=None, sort_window=0, resolutions=None, high_res=False, balance_matrix=True, hic_writer='native'):
+    """
+    Estimate the runtime, peak disk usage under *tmpdir*, and memory of a
+    liftover() job, and the unique mapping rate of its contacts, from a
+    random sample of about *fraction* of the input.
+
+    Returns a dict of the estimates, which are also logged.
+    """
+    tmpdir = os.path.abspath(os.path.expanduser(tmpdir))
+    if not os.path.exists(tmpdir):
+        os.makedirs(tmpdir)
+    rng = np.random.default_rng(seed)
+    chrom_index = get_chrom_order(out_chroms)
+    resolutions = get_resolutions(resolutions, high_res)
+
+    if (intermediate == 'text') and (in_format == 'pairs') and sort_window and \
+        is_sorted_pairs(_input_header(in_path)):
+        log.warning('The input pairs are sorted, which liftover() handles through a window of {0:,} pairs; this '
+                    'is not modelled, the estimates assume a full external sort'.format(sort_window))
+    if (out_format == 'hic') and (hic_writer == 'juicer'):
+        log.warning('The runtime of juicer_tools is not modelled, the estimates leave out the contact matrices')
+
+    start = time.time()
+    if in_assembly != out_assembly:
+        lo = load_liftover(in_assembly, out_assembly, chain_file, via_assembly=via_assembly, in_chroms=in_chroms)
+        mappable = MappableIndex(lo, chrom_index, seed=seed)
+        mappable.build_all(nproc=nproc)
+    else:
+        lo = None
+        mappable = None
+    chain_time = time.time() - start
+
+    log.info('Sampling about {0:.2%} of {1} ...'.format(fraction, in_path))
+    if in_format in ['pairs', 'hic-pro']:
+        sample, scale = sample_pairs(in_path, fraction, rng)
+    elif in_format == 'juicer':
+        sample, scale = sample_hic(in_path, fraction, rng)
+    else:
+        sample, scale = sample_cooler(in_path, fraction, rng)
+
+    # lifted lines are kept to measure their size and compression ratios
+    sink = io.StringIO()
+    executor = ThreadPoolExecutor(max_workers=nproc) if nproc > 1 else None
+    total_count = 0
+    mapped_count = 0
+    start = time.time()
+    if in_format in ['cooler', 'juicer']:
+        for line in sample:
+            total_count, mapped_count = _pixel_to_reads(sink, line, chrom_index, None, lo, None, in_format,
+                                                        total_count, mapped_count, sampler=mappable)
+    elif not lo is None:
+        for i in range(0, len(sample), 100000):
+            total_count, mapped_count = _pairs_write_batch(sink, sample[i:i+100000], chrom_index, mappable, in_format,
+                                                           total_count, mapped_count, executor=executor)
+    else:
+        for line in sample:
+            total_count, mapped_count = _pairs_write(sink, line, chrom_index, None, lo, None, in_format,
+                                                     total_count, mapped_count)
+    convert_time = time.time() - start
+    if not executor is None:
+        executor.shutdown()
+    if not total_count:
+        raise ValueError('No contacts were sampled from {0}, try a larger fraction'.format(in_path))
+
+    data = sink.getvalue().encode()
+    records = _binary_records(data, chrom_index)
+    total = total_count * scale
+    mapped = mapped_count * scale
+    # zlib at levels 6 and 1 stand for bgzip and for the lz4 sort spills
+    gz_bytes = len(zlib.compress(data, 6)) * scale
+    spill_bytes = len(zlib.compress(data, 1)) * scale
+    binary_bytes = mapped * PAIRS_DTYPE.itemsize
+    # memory of a run of BinaryPairsWriter (5,000,000 records), its sort keys and the sorted copy
+    run_memory = 3 * 5000000 * PAIRS_DTYPE.itemsize
+
+    convert_estimate = convert_time * scale
+    sort_estimate = 0
+    if mapped_count > 1:
+        if intermediate == 'text':
+            sort_time = _time_sort(data, tmpdir, nproc)
+        else:
+            # binary runs and shard parts are sorted in memory, and merged afterwards
+            start = time.time()
+            sort_binary_pairs(records)
+            sort_time = time.time() - start
+        sort_estimate = sort_time * scale * math.log(max(mapped, 2)) / math.log(mapped_count)
+
+    matrix_estimate = 0
+    pixels = None
+    if ((out_format == 'cool') or ((out_format == 'hic') and (hic_writer == 'native'))) and len(records):
+        # bin tables, file creation and balancing do not grow with the contacts
+        fixed = _time_matrix(records[:1], out_format, out_chroms, resolutions, out_assembly,
+                             balance_matrix, tmpdir, nproc)
+        sampled = _time_matrix(records, out_format, out_chroms, resolutions, out_assembly,
+                               balance_matrix, tmpdir, nproc)
+        sampled_pixels, pixels = _expected_pixels(records, resolutions[0], scale)
+        matrix_estimate = fixed + max(sampled - fixed, 0) * pixels / sampled_pixels
+    runtime = chain_time + convert_estimate + sort_estimate + matrix_estimate
+
+    if intermediate == 'text':
+        # the sort spills and the sorted pairs.gz coexist until the sort ends
+        disk = spill_bytes + gz_bytes
+        peak = parse_size(SORT_BUFFER)
+    elif intermediate == 'binary':
+        disk = binary_bytes
+        peak = run_memory
+    else:
+        # the parts of a shard are kept until its merged copy is written, for
+        # at most nproc shards at a time, largest first
+        key = (records['chrom1'].astype(np.int64) << 20) | records['chrom2']
+        shards = np.sort(np.unique(key, return_counts=True)[1])[::-1]
+        merged = int(shards[:nproc].sum()) * scale * PAIRS_DTYPE.itemsize
+        disk = binary_bytes + merged
+        # the merge buffers of all workers are sized after --memory, but never
+        # exceed the shards being merged (with the merged block and its copy)
+        peak = max(run_memory, min(parse_size(memory), 3 * merged))
+    # the peak RSS of this process holds the mappable segments of the chains
+    peak += resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if out_format == 'pairs':
+        output = gz_bytes
+    elif out_format == 'npy':
+        output = binary_bytes
+    else:
+        output = None
+
+    report = {
+        'sampled contacts': total_count,
+        'contacts': int(total),
+        'mapped contacts': int(mapped),
+        'mapping rate': mapped_count / total_count,
+        'chain loading seconds': chain_time,
+        'conversion seconds': convert_estimate,
+        'sort seconds': sort_estimate,
+        'matrix seconds': matrix_estimate,
+        'base resolution pixels': pixels,
+        'runtime seconds': runtime,
+        'peak tmpdir bytes': disk,
+        'peak memory bytes': peak,
+        'output bytes': output
+    }
+    log.info('Dry run estimates (from {0:,} sampled contacts):'.format(total_count))
+    log.info('  contacts in the input: {0:,}'.format(int(total)))
+    log.info('  uniquely mapped: {0:,} ({1:.2%})'.format(int(mapped), report['mapping rate']))
+    log.info('  runtime: {0} (chains {1}, conversion {2}, sort {3}, contact matrices {4})'.format(
+        _human_time(runtime), _human_time(chain_time), _human_time(convert_estimate), _human_time(sort_estimate),
+        _human_time(matrix_estimate)))
+    log.info('  peak disk usage under {0}: {1}'.format(tmpdir, _human(disk)))
+    log.info('  peak memory: {0}'.format(_human(peak)))
+    if not pixels is None:
+        log.info('  non-zero pixels at {0}: {1:,}'.format(resolutions[0], pixels))
+    if not output is None:
+        log.info('  output size: {0}'.format(_human(output)))
+
+    return report
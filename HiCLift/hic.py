@@ -0,0 +1,467 @@
+'''
+Streaming writer of .hic files (version 8), replacing "juicer_tools pre".
+
+Contacts are binned chromosome pair by chromosome pair, and every resolution
+is cut into blocks as soon as all of its rows are complete, so memory use is
+bounded by one stripe of blocks per resolution. Blocks are compressed in
+parallel by a thread pool. Contacts arriving after their block was written
+are merged into a new copy of the block. The whole-genome ("All") matrix is
+binned as in "juicer_tools pre", at about 500 bins per side.
+
+The layout follows the .hic format specification of the Aiden lab:
+https://github.com/aidenlab/hic-format/blob/master/HiCFormatV8.md
+
+Coverage (VC) normalization vectors are computed from the intra-chromosomal
+contacts, together with the observed and VC-normalized expected vectors
+(plain averages per distance, without the smoothing of juicer_tools). KR
+normalization is not computed.
+
+'''
+
+import struct, zlib, logging, HiCLift
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from HiCLift.io import open_pairs
+
+log = logging.getLogger(__name__)
+
+HIC_VERSION = 8
+
+def _cstr(s):
+
+    return s.encode('utf-8') + b'\0'
+
+def _encode_block(x, y, v, x_offset, y_offset):
+    """
+    Build and compress a block of records stored as a list of rows.
+    """
+    order = np.lexsort((x, y))
+    x, y, v = x[order], y[order], v[order]
+    rows, starts, counts = np.unique(y, return_index=True, return_counts=True)
+    cells = np.empty(len(x), dtype=[('x', '<i2'), ('v', '<f4')])
+    cells['x'] = x - x_offset
+    cells['v'] = v
+    # nRecords, binXOffset, binYOffset, useShort (1: float counts), type (1: list of rows), rowCount
+    parts = [struct.pack('<iiibbh', len(x), x_offset, y_offset, 1, 1, len(rows))]
+    for r, s, n in zip(rows, starts, counts):
+        parts.append(struct.pack('<hh', r - y_offset, n))
+        parts.append(cells[s:s+n].tobytes())
+
+    return zlib.compress(b''.join(parts))
+
+def _decode_block(data):
+    """
+    Returns the records (x, y, counts) of a block written by _encode_block.
+    """
+    data = zlib.decompress(data)
+    _, x_offset, y_offset, _, _, row_count = struct.unpack('<iiibbh', data[:16])
+    cell = np.dtype([('x', '<i2'), ('v', '<f4')])
+    x, y, v = [], [], []
+    i = 16
+    for _ in range(row_count):
+        r, n = struct.unpack('<hh', data[i:i+4])
+        cells = np.frombuffer(data, dtype=cell, count=n, offset=i+4)
+        x.append(cells['x'].astype(np.int64) + x_offset)
+        y.append(np.full(n, r + y_offset, dtype=np.int64))
+        v.append(cells['v'].astype(np.float64))
+        i += 4 + n * cell.itemsize
+
+    return np.concatenate(x), np.concatenate(y), np.concatenate(v)
+
+class _ZoomData:
+    """
+    Binned contacts of one chromosome pair at one resolution.
+    """
+    def __init__(self, resolution, len1, len2, block_bin_count, intra=False):
+
+        self.resolution = resolution
+        self.block_bin_count = block_bin_count
+        nbins = max(len1, len2) // resolution + 1
+        self.block_column_count = nbins // block_bin_count + 1
+        self.x = []
+        self.y = []
+        self.v = []
+        # block number --> (position, size) of the written blocks
+        self.blocks = {}
+        self.sum_counts = 0
+        self.occupied = 0
+        # coverage of the bins of an intra-chromosomal matrix (diagonal counted once)
+        self.rows = np.zeros(len1 // resolution + 1) if intra else None
+
+    def add(self, x, y):
+
+        n = (y.max() + 1) if len(y) else 1
+        uniq, counts = np.unique(x * n + y, return_counts=True)
+        self.x.append(uniq // n)
+        self.y.append(uniq % n)
+        self.v.append(counts)
+        self.sum_counts += len(x)
+        if not self.rows is None:
+            self.rows += np.bincount(x, minlength=len(self.rows))
+            self.rows += np.bincount(y[x != y], minlength=len(self.rows))
+
+    def pop_blocks(self, done_col=None):
+        """
+        Returns (block number, x, y, counts) of the finished blocks, i.e. the blocks
+        whose column is smaller than done_col (all blocks if done_col is None).
+        """
+        if not len(self.x):
+            return []
+        x = np.concatenate(self.x)
+        y = np.concatenate(self.y)
+        v = np.concatenate(self.v)
+        col = x // self.block_bin_count
+        if done_col is None:
+            mask = np.ones(len(x), dtype=bool)
+        else:
+            mask = col < done_col
+        self.x, self.y, self.v = [x[~mask]], [y[~mask]], [v[~mask]]
+        if not mask.any():
+            return []
+
+        x, y, v = x[mask], y[mask], v[mask]
+        n = y.max() + 1
+        uniq, inv = np.unique(x * n + y, return_inverse=True)
+        v = np.bincount(inv, weights=v)
+        x, y = uniq // n, uniq % n
+        self.occupied += len(x)
+        number = (y // self.block_bin_count) * self.block_column_count + x // self.block_bin_count
+        order = np.argsort(number, kind='stable')
+        x, y, v, number = x[order], y[order], v[order], number[order]
+        uniq, starts = np.unique(number, return_index=True)
+        ends = np.r_[starts[1:], len(number)]
+        blocks = []
+        for b, s, e in zip(uniq, starts, ends):
+            blocks.append((int(b), x[s:e], y[s:e], v[s:e]))
+
+        return blocks
+
+class HicWriter:
+    """
+    Write contacts into a .hic file.
+
+    Parameters
+    ----------
+    path : str
+        Output path.
+
+    chromsizes : list of (str, int)
+        Chromosomes of the target assembly. Contacts must be given with chrom1
+        placed before chrom2 in this list.
+
+    resolutions : list of int
+        Base-pair resolutions.
+
+    genome : str
+        Genome ID stored in the header.
+
+    nproc : int
+        Number of threads used to compress blocks.
+
+    block_bin_count : int
+        Number of bins along each side of a block (at most 32767).
+    """
+    def __init__(self, path, chromsizes, resolutions, genome='unknown', nproc=1, block_bin_count=1000):
+
+        # opened for reading too, to merge late contacts into written blocks
+        self.f = open(path, 'w+b')
+        self.chromsizes = dict(chromsizes)
+        # index 0 is reserved for the "All" pseudo-chromosome
+        self.chrom_index = {c: i + 1 for i, (c, _) in enumerate(chromsizes)}
+        self.chrom_names = [c for c, _ in chromsizes]
+        self.resolutions = sorted(resolutions, reverse=True)
+        self.block_bin_count = block_bin_count
+        self.executor = ThreadPoolExecutor(max_workers=nproc)
+        self.master_index = []
+        self.pairs_done = set()
+        self.pair = None
+        # (normalization, resolution) --> contacts summed by distance, and by chromosome index
+        self.distance_sums = {}
+        self.chrom_sums = {}
+        # (normalization, chromosome index, resolution, position, size) of the written vectors
+        self.norm_vectors = []
+
+        genome_length = sum(self.chromsizes.values())
+        # the "All" matrix bins genome-wide positions in kb
+        self.genome_offsets = {}
+        offset = 0
+        for c, length in chromsizes:
+            self.genome_offsets[c] = offset
+            offset += length
+        self.whole_genome = _ZoomData(max(1, genome_length // 1000 // 500), genome_length // 1000,
+                                      genome_length // 1000, block_bin_count)
+        nbins = genome_length // 1000 // self.whole_genome.resolution + 1
+        self.whole_genome_counts = np.zeros((nbins, nbins), dtype=np.float64)
+        header = [b'HIC\0', struct.pack('<i', HIC_VERSION), struct.pack('<q', 0), _cstr(genome)]
+        header.append(struct.pack('<i', 1))
+        header.append(_cstr('software') + _cstr('HiCLift {0}'.format(HiCLift.__version__)))
+        header.append(struct.pack('<i', len(chromsizes) + 1))
+        header.append(_cstr('All') + struct.pack('<i', genome_length // 1000))
+        for c, length in chromsizes:
+            header.append(_cstr(c) + struct.pack('<i', length))
+        header.append(struct.pack('<i', len(self.resolutions)))
+        header.append(struct.pack('<{0}i'.format(len(self.resolutions)), *self.resolutions))
+        header.append(struct.pack('<i', 0)) # no fragment resolutions
+        self.f.write(b''.join(header))
+
+    def _start_pair(self, chrom1, chrom2):
+
+        if (chrom1, chrom2) in self.pairs_done:
+            raise ValueError('Contacts must be grouped by chromosome pairs ({0}, {1})'.format(chrom1, chrom2))
+        self.pair = (chrom1, chrom2)
+        self.sorted = True
+        self.last_pos = -1
+        len1, len2 = self.chromsizes[chrom1], self.chromsizes[chrom2]
+        self.zooms = [_ZoomData(r, len1, len2, self.block_bin_count, intra=(chrom1 == chrom2))
+                      for r in self.resolutions]
+
+    def _merge_written(self, zoom, b, x, y, v):
+        """
+        Merge records into a block that was already written.
+        """
+        position, size = zoom.blocks[b]
+        self.f.seek(position)
+        old_x, old_y, old_v = _decode_block(self.f.read(size))
+        self.f.seek(0, 2)
+        x, y, v = np.r_[old_x, x], np.r_[old_y, y], np.r_[old_v, v]
+        n = y.max() + 1
+        uniq, inv = np.unique(x * n + y, return_inverse=True)
+        # pop_blocks counted the new records as occupied cells
+        zoom.occupied -= len(x) - len(uniq)
+
+        return uniq // n, uniq % n, np.bincount(inv, weights=v)
+
+    def _write_blocks(self, zoom, blocks):
+
+        blocks = [(b, x, y, v) if not b in zoom.blocks else (b,) + self._merge_written(zoom, b, x, y, v)
+                  for b, x, y, v in blocks]
+        futures = [(b, self.executor.submit(_encode_block, x, y, v,
+                                            (b % zoom.block_column_count) * zoom.block_bin_count,
+                                            (b // zoom.block_column_count) * zoom.block_bin_count))
+                   for b, x, y, v in blocks]
+        for b, future in futures:
+            data = future.result()
+            # a merged block replaces the previous copy in the index
+            zoom.blocks[b] = (self.f.tell(), len(data))
+            self.f.write(data)
+
+    def _write_matrix(self, i, j, zooms):
+
+        parts = [struct.pack('<iii', i, j, len(zooms))]
+        for zoom_index, zoom in enumerate(zooms):
+            parts.append(_cstr('BP'))
+            parts.append(struct.pack('<iffffiiii', zoom_index, zoom.sum_counts, zoom.occupied, 0, 0,
+                                     zoom.resolution, zoom.block_bin_count, zoom.block_column_count,
+                                     len(zoom.blocks)))
+            for b in sorted(zoom.blocks):
+                parts.append(struct.pack('<iqi', b, *zoom.blocks[b]))
+        data = b''.join(parts)
+        self.master_index.append(('{0}_{1}'.format(i, j), self.f.tell(), len(data)))
+        self.f.write(data)
+
+    def _finish_pair(self):
+
+        if self.pair is None:
+            return
+        for zoom in self.zooms:
+            self._write_blocks(zoom, zoom.pop_blocks())
+
+        chrom1, chrom2 = self.pair
+        self._write_matrix(self.chrom_index[chrom1], self.chrom_index[chrom2], self.zooms)
+
+        if chrom1 == chrom2:
+            for zoom in self.zooms:
+                self._write_coverage(self.chrom_index[chrom1], zoom)
+
+        self.pairs_done.add(self.pair)
+        self.pair = None
+
+    def _write_coverage(self, i, zoom):
+        """
+        Write the VC normalization vector of an intra-chromosomal matrix, and add
+        its contacts (observed and normalized) to the sums of the expected vectors.
+        """
+        vc = zoom.rows.copy()
+        vc[vc == 0] = np.nan
+        nbins = max(self.chromsizes.values()) // zoom.resolution + 1
+        observed = np.zeros(nbins)
+        normalized = np.zeros(nbins)
+        norm_sum, matrix_sum = 0, 0
+        # blocks are read back one by one to keep memory bounded
+        for b in sorted(zoom.blocks):
+            position, size = zoom.blocks[b]
+            self.f.seek(position)
+            x, y, v = _decode_block(self.f.read(size))
+            d = y - x
+            observed += np.bincount(d, weights=v, minlength=nbins)
+            w = v / (vc[x] * vc[y])
+            valid = np.isfinite(w)
+            # off-diagonal contacts count twice in the symmetric matrix
+            twice = np.where(d[valid] > 0, 2, 1)
+            norm_sum += (w[valid] * twice).sum()
+            matrix_sum += (v[valid] * twice).sum()
+            normalized += np.bincount(d[valid], weights=w[valid], minlength=nbins)
+        self.f.seek(0, 2)
+
+        # scale the vector so that the normalized matrix keeps the sum of the observed one
+        if norm_sum > 0:
+            factor = np.sqrt(norm_sum / matrix_sum)
+            vc *= factor
+            normalized /= factor ** 2
+        for norm, sums in [('NONE', observed), ('VC', normalized)]:
+            key = (norm, zoom.resolution)
+            self.distance_sums[key] = self.distance_sums.get(key, 0) + sums
+            self.chrom_sums.setdefault(key, {})[i] = sums.sum()
+
+        data = struct.pack('<i', len(vc)) + vc.astype('<f8').tobytes()
+        self.norm_vectors.append(('VC', i, zoom.resolution, self.f.tell(), len(data)))
+        self.f.write(data)
+
+    def _expected(self, norm, resolution):
+        """
+        Expected vector (average contacts by distance over all chromosomes) and the
+        chromosome scale factors of a normalization at a resolution.
+        """
+        sums = self.distance_sums[(norm, resolution)]
+        possible = np.zeros(len(sums))
+        for length in self.chromsizes.values():
+            n = length // resolution + 1
+            possible[:n] += n - np.arange(n)
+        expected = sums / possible
+        factors = []
+        for i, observed in sorted(self.chrom_sums[(norm, resolution)].items()):
+            n = self.chromsizes[self.chrom_names[i - 1]] // resolution + 1
+            if observed > 0:
+                factors.append((i, (expected[:n] * (n - np.arange(n))).sum() / observed))
+
+        return expected, factors
+
+    def _expected_vectors(self, norm):
+
+        parts = []
+        resolutions = [r for r in self.resolutions if (norm, r) in self.distance_sums]
+        for r in resolutions:
+            expected, factors = self._expected(norm, r)
+            if norm != 'NONE':
+                parts.append(_cstr(norm))
+            parts.append(_cstr('BP') + struct.pack('<ii', r, len(expected)))
+            parts.append(expected.astype('<f8').tobytes())
+            parts.append(struct.pack('<i', len(factors)))
+            parts.extend(struct.pack('<id', i, f) for i, f in factors)
+
+        return [struct.pack('<i', len(resolutions))] + parts
+
+    def _finish_whole_genome(self):
+
+        zoom = self.whole_genome
+        x, y = np.nonzero(self.whole_genome_counts)
+        zoom.x, zoom.y, zoom.v = [x], [y], [self.whole_genome_counts[x, y]]
+        self._write_blocks(zoom, zoom.pop_blocks())
+        self._write_matrix(0, 0, [zoom])
+
+    def add(self, chrom1, chrom2, pos1, pos2):
+        """
+        Add contacts between chrom1 and chrom2 (two arrays of positions). Contacts of
+        a chromosome pair must be added in consecutive calls; memory stays bounded
+        if pos1 is sorted, otherwise the blocks are only written once the pair is
+        complete.
+        """
+        if self.chrom_index[chrom1] > self.chrom_index[chrom2]:
+            chrom1, chrom2, pos1, pos2 = chrom2, chrom1, pos2, pos1
+        if (chrom1, chrom2) != self.pair:
+            self._finish_pair()
+            self._start_pair(chrom1, chrom2)
+        if not len(pos1):
+            return
+
+        pos1 = np.asarray(pos1, dtype=np.int64)
+        pos2 = np.asarray(pos2, dtype=np.int64)
+        if chrom1 == chrom2:
+            flipped = pos1 > pos2
+            if flipped.any():
+                self.sorted = False
+                pos1, pos2 = np.where(flipped, pos2, pos1), np.where(flipped, pos1, pos2)
+        if (pos1[0] < self.last_pos) or np.any(pos1[1:] < pos1[:-1]):
+            self.sorted = False
+        self.last_pos = pos1[-1]
+
+        wg = self.whole_genome
+        g1 = (self.genome_offsets[chrom1] + pos1) // 1000 // wg.resolution
+        g2 = (self.genome_offsets[chrom2] + pos2) // 1000 // wg.resolution
+        nbins = len(self.whole_genome_counts)
+        self.whole_genome_counts += np.bincount(np.minimum(g1, g2) * nbins + np.maximum(g1, g2),
+                                                minlength=nbins * nbins).reshape(nbins, nbins)
+        wg.sum_counts += len(pos1)
+
+        for zoom in self.zooms:
+            zoom.add(pos1 // zoom.resolution, pos2 // zoom.resolution)
+            if self.sorted:
+                done_col = (self.last_pos // zoom.resolution) // zoom.block_bin_count
+                self._write_blocks(zoom, zoom.pop_blocks(done_col))
+
+    def close(self):
+
+        self._finish_pair()
+        self._finish_whole_genome()
+        self.executor.shutdown()
+
+        master_position = self.f.tell()
+        parts = [struct.pack('<i', len(self.master_index))]
+        for key, position, size in self.master_index:
+            parts.append(_cstr(key) + struct.pack('<qi', position, size))
+        parts.extend(self._expected_vectors('NONE'))
+        parts.extend(self._expected_vectors('VC'))
+        parts.append(struct.pack('<i', len(self.norm_vectors)))
+        for norm, i, resolution, position, size in self.norm_vectors:
+            parts.append(_cstr(norm) + struct.pack('<i', i) + _cstr('BP') + struct.pack('<iqi', resolution, position, size))
+        data = b''.join(parts)
+        self.f.write(struct.pack('<i', len(data)))
+        self.f.write(data)
+
+        self.f.seek(8)
+        self.f.write(struct.pack('<q', master_position))
+        self.f.close()
+
+def write_hic_binary(blocks, out_path, chromsizes, resolutions, genome='unknown', nproc=1):
+    """
+    Bin sorted blocks of binary pairs records (see HiCLift.io.PAIRS_DTYPE) into a .hic file.
+    """
+    writer = HicWriter(out_path, chromsizes, resolutions, genome=genome, nproc=nproc)
+    names = [c for c, _ in chromsizes]
+    for block in blocks:
+        key = (block['chrom1'].astype(np.int64) << 20) | block['chrom2']
+        bounds = np.r_[0, np.flatnonzero(np.diff(key)) + 1, len(key)]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            if e > s:
+                writer.add(names[block['chrom1'][s] - 1], names[block['chrom2'][s] - 1],
+                           block['pos1'][s:e], block['pos2'][s:e])
+    
+    writer.close()
+
+def write_hic(pairs_path, out_path, chromsizes, resolutions, genome='unknown', nproc=1, chunksize=1000000):
+    """
+    Bin a pairs file, sorted or at least grouped by chromosome pairs, into a .hic file.
+    """
+    writer = HicWriter(out_path, chromsizes, resolutions, genome=genome, nproc=nproc)
+    instream = open_pairs(pairs_path, mode='r', nproc=nproc)
+    current = None
+    pos1, pos2 = [], []
+    for line in instream:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t', 5)
+        if len(fields) < 5:
+            continue
+        pair = (fields[1], fields[3])
+        if (pair != current) or (len(pos1) >= chunksize):
+            if len(pos1):
+                writer.add(current[0], current[1], pos1, pos2)
+            current = pair
+            pos1, pos2 = [], []
+        pos1.append(int(fields[2]))
+        pos2.append(int(fields[4]))
+    if len(pos1):
+        writer.add(current[0], current[1], pos1, pos2)
+
+    instream.close()
+    writer.close()
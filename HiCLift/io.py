@@ -1,4 +1,7 @@
-import pipes, subprocess, struct, hicstraw, sys, os, random
+import pipes, subprocess, struct, hicstraw, sys, os, random, heapq
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from HiCLift.chainfile import _parse_chains
 
 def generate_hic_blocks(chromsizes, step=10000000):
 
@@ -85,9 +88,12 @@ def read_hic_header(hicfile):
     
     return info
 
-def read_hic_file(hicfil):
-
-    hic = hicstraw.HiCFile(hicfil)
+def hic_tiles(hicfil):
+    """
+    Split the contact matrices of a .hic file at its highest resolution into
+    the tiles read by read_hic_file. Returns the header information and a list
+    of (chrom1, chrom2, start1, end1, start2, end2) tiles.
+    """
     info = read_hic_header(hicfil)
     chromsizes = info['chromsizes']
     binsize = min(info['resolutions'])
@@ -97,6 +103,7 @@ def read_hic_file(hicfil):
     else:
         step = 10000000
 
+    tiles = []
     chroms = sort_chromlabels(list(chromsizes))
     for i in range(len(chroms)):
         for j in range(len(chroms)):
@@ -105,24 +112,229 @@ def read_hic_file(hicfil):
             
             c1 = chroms[i]
             c2 = chroms[j]
-            _c1 = 'chr' + c1.lstrip('chr')
-            _c2 = 'chr' + c2.lstrip('chr')
-            mzd = hic.getMatrixZoomData(c1, c2, "observed", "NONE", "BP", binsize)
             for bs_1 in range(0, chromsizes[c1], step):
                 for bs_2 in range(0, chromsizes[c2], step):
                     be_1 = min(chromsizes[c1], bs_1 + step - 1)
                     be_2 = min(chromsizes[c2], bs_2 + step - 1)
-                    records_list = mzd.getRecords(bs_1, be_1, bs_2, be_2)
-                    for k in records_list:
-                        s1 = k.binX
-                        s2 = k.binY
-                        e1 = min(s1 + binsize, chromsizes[c1])
-                        e2 = min(s2 + binsize, chromsizes[c2])
-                        yield _c1, s1, e1, _c2, s2, e2, int(k.counts)
-
-def open_pairs(path, mode, data_format='pairs', nproc=1):
+                    tiles.append((c1, c2, bs_1, be_1, bs_2, be_2))
+
+    return info, tiles
+
+def read_hic_file(hicfil, tiles=None):
+
+    hic = hicstraw.HiCFile(hicfil)
+    info, all_tiles = hic_tiles(hicfil)
+    if tiles is None:
+        tiles = all_tiles
+    chromsizes = info['chromsizes']
+    binsize = min(info['resolutions'])
+
+    mzd = None
+    pair = None
+    for c1, c2, bs_1, be_1, bs_2, be_2 in tiles:
+        if (mzd is None) or ((c1, c2) != pair):
+            pair = (c1, c2)
+            _c1 = 'chr' + c1.lstrip('chr')
+            _c2 = 'chr' + c2.lstrip('chr')
+            mzd = hic.getMatrixZoomData(c1, c2, "observed", "NONE", "BP", binsize)
+        records_list = mzd.getRecords(bs_1, be_1, bs_2, be_2)
+        for k in records_list:
+            s1 = k.binX
+            s2 = k.binY
+            e1 = min(s1 + binsize, chromsizes[c1])
+            e2 = min(s2 + binsize, chromsizes[c2])
+            yield _c1, s1, e1, _c2, s2, e2, int(k.counts)
+
+# record layout of the binary columnar pairs format; chromosomes are
+# stored as the 1-based codes returned by utilities.get_chrom_order
+PAIRS_DTYPE = np.dtype([('chrom1', '<i4'), ('pos1', '<i4'), ('chrom2', '<i4'), ('pos2', '<i4'),
+                        ('strand1', 'S1'), ('strand2', 'S1')])
+
+def _binary_sort_key(records):
+
+    hi = (records['chrom1'].astype(np.int64) << 20) | records['chrom2']
+    lo = (records['pos1'].astype(np.int64) << 32) | records['pos2']
+
+    return hi, lo
+
+def sort_binary_pairs(records):
+
+    hi, lo = _binary_sort_key(records)
+
+    return records[np.lexsort((lo, hi))]
+
+def merge_binary_runs(paths, blocksize=1000000):
+    """
+    Streaming k-way merge of sorted .npy runs of PAIRS_DTYPE records.
+    Yields sorted blocks of records.
+    """
+    runs = [np.load(p, mmap_mode='r') for p in paths]
+    cursors = [0] * len(runs)
+    buffers = [runs[i][:0] for i in range(len(runs))]
+    while True:
+        active = []
+        for i, run in enumerate(runs):
+            if (not len(buffers[i])) and (cursors[i] < len(run)):
+                buffers[i] = np.array(run[cursors[i]:cursors[i]+blocksize])
+                cursors[i] += blocksize
+            if len(buffers[i]):
+                active.append(i)
+        if not active:
+            break
+        
+        # everything up to the smallest last key of the buffers can be emitted
+        bound = min(tuple(k[-1] for k in _binary_sort_key(buffers[i])) for i in active)
+        parts = []
+        for i in active:
+            hi, lo = _binary_sort_key(buffers[i])
+            n = np.count_nonzero((hi < bound[0]) | ((hi == bound[0]) & (lo <= bound[1])))
+            parts.append(buffers[i][:n])
+            buffers[i] = buffers[i][n:]
+        
+        yield sort_binary_pairs(np.concatenate(parts))
+
+class BinaryPairsWriter:
+    """
+    Collects lifted pairs as columnar records with integer chromosome codes.
+
+    Records are buffered, sorted in memory, and spilled as .npy runs named after
+    *prefix*. After close(), iterating over the writer yields globally sorted
+    blocks of records (PAIRS_DTYPE), ordered by chrom1, chrom2, pos1 and pos2
+    codes, i.e. in the chromosome order of chrom_index.
+    """
+    def __init__(self, prefix, chrom_index, chunksize=5000000):
+
+        self.prefix = prefix
+        self.chrom_index = chrom_index
+        self.chunksize = chunksize
+        self.runs = []
+        self.count = 0
+        self._reset()
+    
+    def _reset(self):
+
+        self.c1, self.p1, self.c2, self.p2, self.s1, self.s2 = [], [], [], [], [], []
+    
+    def _records(self):
+
+        records = np.empty(len(self.c1), dtype=PAIRS_DTYPE)
+        records['chrom1'] = self.c1
+        records['pos1'] = self.p1
+        records['chrom2'] = self.c2
+        records['pos2'] = self.p2
+        records['strand1'] = self.s1
+        records['strand2'] = self.s2
+        self._reset()
+
+        return records
+
+    def _spill(self):
+
+        if not len(self.c1):
+            return
+        path = '{0}.run{1}.npy'.format(self.prefix, len(self.runs))
+        np.save(path, sort_binary_pairs(self._records()))
+        self.runs.append(path)
+
+    def append(self, c1, p1, c2, p2, strand1='.', strand2='.'):
+
+        self.c1.append(self.chrom_index[c1])
+        self.p1.append(p1)
+        self.c2.append(self.chrom_index[c2])
+        self.p2.append(p2)
+        self.s1.append(strand1)
+        self.s2.append(strand2)
+        self.count += 1
+        if len(self.c1) >= self.chunksize:
+            self._spill()
     
-    if data_format == 'cooler':
+    def close(self):
+
+        self._spill()
+    
+    def __iter__(self):
+
+        return merge_binary_runs(self.runs)
+    
+    def remove(self):
+
+        for path in self.runs:
+            os.remove(path)
+
+class ShardedPairsWriter(BinaryPairsWriter):
+    """
+    A BinaryPairsWriter spilling its records into per chromosome pair shards
+    under *workdir*. Every spill adds a sorted part to the shards it touches
+    ("{chrom1}-{chrom2}.part{i}.npy", with chromosome codes); the parts of a
+    shard are merged by HiCLift.shards.sort_shards.
+
+    After close(), *shards* maps the shard names to their numbers of records.
+    """
+    def __init__(self, workdir, chrom_index, chunksize=5000000):
+
+        super().__init__(os.path.join(workdir, 'pairs'), chrom_index, chunksize=chunksize)
+        self.workdir = workdir
+        self.shards = {}
+        self.parts = 0
+
+    def _spill(self):
+
+        if not len(self.c1):
+            return
+        records = sort_binary_pairs(self._records())
+        key = (records['chrom1'].astype(np.int64) << 20) | records['chrom2']
+        bounds = np.r_[0, np.flatnonzero(np.diff(key)) + 1, len(key)]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            name = '{0}-{1}'.format(records['chrom1'][s], records['chrom2'][s])
+            np.save(os.path.join(self.workdir, '{0}.part{1}.npy'.format(name, self.parts)), records[s:e])
+            self.shards[name] = self.shards.get(name, 0) + int(e - s)
+        self.parts += 1
+
+def write_binary_pairs(path, blocks, count):
+    """
+    Write sorted blocks of records into a single .npy file holding *count* records.
+    """
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=PAIRS_DTYPE, shape=(count,))
+    i = 0
+    for block in blocks:
+        out[i:i+len(block)] = block
+        i += len(block)
+    out.flush()
+    del out
+
+def write_text_pairs(outstream, blocks, chrom_names):
+    """
+    Format blocks of binary records as 4DN pairs lines.
+    """
+    names = np.asarray([''] + list(chrom_names), dtype=object)
+    for block in blocks:
+        c1 = names[block['chrom1']]
+        c2 = names[block['chrom2']]
+        s1 = block['strand1'].astype('U1')
+        s2 = block['strand2'].astype('U1')
+        outstream.writelines('.\t{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(*row)
+                             for row in zip(c1, block['pos1'].tolist(), c2, block['pos2'].tolist(), s1, s2))
+
+def _write_pair(outstream, cols):
+
+    if isinstance(outstream, BinaryPairsWriter):
+        outstream.append(cols[1], int(cols[2]), cols[3], int(cols[4]), cols[5], cols[6])
+    else:
+        outstream.write('\t'.join(map(str, cols)) + '\n')
+
+def open_pairs(path, mode, data_format='pairs', nproc=1, chrom_index=None):
+    """
+    Open a stream of contacts. With data_format='binary', mode 'w' returns a
+    BinaryPairsWriter using *path* as the prefix of its runs (chrom_index
+    is required), and mode 'r' returns blocks of records read from a .npy file.
+    """
+    if data_format == 'binary':
+        if mode == 'w':
+            return BinaryPairsWriter(path, chrom_index)
+        else:
+            records = np.load(path, mmap_mode='r')
+            return (np.array(records[i:i+1000000]) for i in range(0, len(records), 1000000))
+    elif data_format == 'cooler':
         pread = subprocess.Popen(['cooler', 'dump', '--join', path],
                               stdout = subprocess.PIPE, bufsize = -1)
         f = pread.stdout
@@ -158,6 +370,113 @@ def open_pairs(path, mode, data_format='pairs', nproc=1):
             return open(path, mode)
 
 
+def pairs_sort_key(line):
+    """
+    Sort key of a lifted pairs line, consistent with the external sort
+    used by HiCLift (-k 2,2 -k 4,4 -k 3,3n -k 5,5n under LC_COLLATE=C).
+    """
+    fields = line.split('\t', 5)
+
+    return fields[1], fields[3], int(fields[2]), int(fields[4])
+
+class BoundedWindowSorter:
+    """
+    A write-only stream for lifted pairs coming from a sorted input.
+
+    Liftover within a chromosome pair is nearly monotone, so the lines are passed
+    through a bounded window (a heap of at most *window* lines) and written to
+    *runstream* as long as they come out in order. Lines that cannot be placed in
+    the sorted run (inversions, translocations, flipped pairs) are written to
+    *spillstream* instead, which is expected to feed a (much smaller) external sort.
+
+    Only lines on the dominant chromosome pair enter the window. The dominant pair
+    changes after *switch* consecutive lines on a new chromosome pair, so that
+    occasional translocated lines cannot derail the sorted run.
+    """
+    def __init__(self, runstream, spillstream, window=100000, switch=64):
+
+        self.runstream = runstream
+        self.spillstream = spillstream
+        self.window = window
+        self.switch = switch
+        self.heap = []
+        self.last = None
+        self.pair = None
+        self.candidate = None
+        self.candidate_count = 0
+        self.counter = 0
+        self.run_count = 0
+        self.spill_count = 0
+    
+    def _spill(self, line):
+
+        self.spillstream.write(line)
+        self.spill_count += 1
+    
+    def _emit(self, key, line):
+
+        if (self.last is None) or (key >= self.last):
+            self.runstream.write(line)
+            self.last = key
+            self.run_count += 1
+        else:
+            self._spill(line)
+    
+    def _flush(self):
+
+        while self.heap:
+            key, _, line = heapq.heappop(self.heap)
+            self._emit(key, line)
+
+    def write(self, line):
+
+        key = pairs_sort_key(line)
+        pair = key[:2]
+        if pair != self.pair:
+            if self.pair is None:
+                self.pair = pair
+            else:
+                if pair == self.candidate:
+                    self.candidate_count += 1
+                else:
+                    self.candidate = pair
+                    self.candidate_count = 1
+                if self.candidate_count < self.switch:
+                    self._spill(line)
+                    return
+                self._flush()
+                self.pair = pair
+                self.candidate = None
+                self.candidate_count = 0
+        else:
+            self.candidate = None
+            self.candidate_count = 0
+        
+        if (not self.last is None) and (key < self.last):
+            self._spill(line)
+            return
+        
+        heapq.heappush(self.heap, (key, self.counter, line))
+        self.counter += 1
+        if len(self.heap) > self.window:
+            key, _, line = heapq.heappop(self.heap)
+            self._emit(key, line)
+    
+    def flush(self):
+
+        pass
+    
+    def close(self):
+
+        self._flush()
+
+def merge_sorted_pairs(outstream, *instreams):
+    """
+    Streaming k-way merge of sorted lifted pairs streams into *outstream*.
+    """
+    for line in heapq.merge(*instreams, key=pairs_sort_key):
+        outstream.write(line)
+
 def has_correct_order(loci1, loci2, chrom_index):
     
     check = (chrom_index[loci1[0]], loci1[1]) <= (chrom_index[loci2[0]], loci2[1])
@@ -178,7 +497,197 @@ def _core(loci, mapping_table, lo, resolution):
         value = mapping_table.get((c, s), None)
         return value
 
-def _pixel_to_reads(outstream, line, chrom_index, mapping_table, lo, resolution, source, total_count, mapped_count):
+def _mappable_segments(chains, chrom_index):
+    """
+    Sweep over the chain blocks of a source chromosome, and keep the segments
+    covered by a single block whose target chromosome is in chrom_index.
+
+    Returns the arrays (start, end, shift, minus, target size, target code) of
+    the segments, and the target names of the codes.
+    """
+    blocks = [(sfrom, sto, tfrom, c) for c in chains for sfrom, sto, tfrom in c.blocks]
+    empty = np.zeros(0, dtype=np.int64)
+    if not len(blocks):
+        return empty, empty, empty, np.zeros(0, dtype=bool), empty, empty, []
+
+    n = len(blocks)
+    bstart = np.array([b[0] for b in blocks], dtype=np.int64)
+    bend = np.array([b[1] for b in blocks], dtype=np.int64)
+    ids = np.arange(1, n + 1, dtype=np.int64)
+    pos = np.r_[bstart, bend]
+    cover = np.r_[np.ones(n, dtype=np.int64), -np.ones(n, dtype=np.int64)]
+    owner = np.r_[ids, -ids]
+    order = np.argsort(pos, kind='stable')
+    pos, cover, owner = pos[order], cover[order], owner[order]
+    upos, first = np.unique(pos, return_index=True)
+    cover = np.cumsum(np.add.reduceat(cover, first))
+    # where a single block covers a segment, the running sum of ids is its id
+    owner = np.cumsum(np.add.reduceat(owner, first))
+
+    names = []
+    codes = {}
+    for _, _, _, c in blocks:
+        if not c.target_name in codes:
+            codes[c.target_name] = len(names)
+            names.append(c.target_name)
+    shift = np.array([b[2] - b[0] for b in blocks], dtype=np.int64)
+    minus = np.array([b[3].target_strand == '-' for b in blocks], dtype=bool)
+    tsize = np.array([b[3].target_size for b in blocks], dtype=np.int64)
+    tcode = np.array([codes[b[3].target_name] for b in blocks], dtype=np.int64)
+    kept = np.array([b[3].target_name in chrom_index for b in blocks], dtype=bool)
+
+    unique = cover[:-1] == 1
+    block = owner[:-1][unique] - 1
+    start, end = upos[:-1][unique], upos[1:][unique]
+    mask = kept[block]
+    block = block[mask]
+
+    return start[mask], end[mask], shift[block], minus[block], tsize[block], tcode[block], names
+
+def _segments_worker(args):
+
+    data, chrom_index = args
+
+    return _mappable_segments(_parse_chains(data), chrom_index)
+
+class MappableIndex:
+    """
+    Uniquely mappable sub-intervals of the source chromosomes, built from the
+    chain blocks, used to draw read positions inside the pixels of a contact
+    matrix, and to lift positions one source chromosome at a time.
+
+    A source position is uniquely mappable if it is covered by exactly one
+    chain block, and the target chromosome of that block is in chrom_index.
+    Positions are drawn uniformly from the mappable part of a bin, so no
+    draw is ever wasted on unmapped positions.
+
+    The sub-intervals of a chromosome are plain sorted arrays, so once built
+    (see :meth:`chromosome` and :meth:`build_all`), lookups on different
+    chromosomes can run in parallel threads. Building them does not index the
+    chains in the interval trees of the chain file.
+
+    Parameters
+    ----------
+    lo : LiftOver
+        Source of the chain blocks.
+
+    chrom_index : dict
+        Chromosome orders of the target assembly.
+
+    seed : int or None
+        Seed of the random number generator.
+
+    cache_size : int
+        Number of bins whose mappable sub-intervals are kept in memory.
+    """
+    def __init__(self, lo, chrom_index, seed=None, cache_size=100000):
+
+        self.lo = lo
+        self.chrom_index = chrom_index
+        self.rng = np.random.default_rng(seed)
+        self.cache_size = cache_size
+        self.segments = {}
+        self.bins = {}
+        self.target_names = []
+        self.target_rank = np.zeros(0, dtype=np.int64)
+        self._target_code = {}
+
+    def _add(self, chrom, result):
+
+        start, end, shift, minus, tsize, tcode, names = result
+        for name in names:
+            if not name in self._target_code:
+                self._target_code[name] = len(self.target_names)
+                self.target_names.append(name)
+        self.target_rank = np.array([self.chrom_index.get(c, 0) for c in self.target_names], dtype=np.int64)
+        codes = np.array([self._target_code[name] for name in names], dtype=np.int64)
+        self.segments[chrom] = (start, end, shift, minus, tsize, codes[tcode])
+
+    def chromosome(self, chrom):
+        """
+        Returns the arrays (start, end, shift, minus, target size, target code)
+        of the uniquely mappable segments of a source chromosome.
+        """
+        if not chrom in self.segments:
+            self._add(chrom, _mappable_segments(self.lo.chain_file.chains_of(chrom), self.chrom_index))
+
+        return self.segments[chrom]
+
+    def build_all(self, nproc=1):
+        """
+        Build the segments of all source chromosomes of the chain file, parsing
+        the chains of each chromosome in a process pool if nproc > 1. The
+        chains are not added to the interval trees of the chain file.
+        """
+        chain_file = self.lo.chain_file
+        pending = [c for c in chain_file.offsets if not c in self.segments]
+        pending.sort(key=lambda c: len(chain_file.offsets[c]), reverse=True)
+        if (nproc <= 1) or (len(pending) < 2):
+            for chrom in pending:
+                self.chromosome(chrom)
+            return
+
+        tasks = [(chain_file.chain_data(chrom), self.chrom_index) for chrom in pending]
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            for chrom, result in zip(pending, executor.map(_segments_worker, tasks)):
+                self._add(chrom, result)
+
+    def lift(self, chrom, positions):
+        """
+        Lift positions of a source chromosome. Returns the target chromosome
+        codes, the target positions, and the mask of uniquely mapped positions.
+        """
+        start, end, shift, minus, tsize, tcode = self.chromosome(chrom)
+        positions = np.asarray(positions, dtype=np.int64)
+        if not len(start):
+            zeros = np.zeros(len(positions), dtype=np.int64)
+            return zeros, zeros, np.zeros(len(positions), dtype=bool)
+        idx = np.maximum(np.searchsorted(start, positions, side='right') - 1, 0)
+        mapped = (positions >= start[idx]) & (positions < end[idx])
+        lifted = positions + shift[idx]
+        lifted = np.where(minus[idx], tsize[idx] - 1 - lifted, lifted)
+
+        return tcode[idx], lifted, mapped
+
+    def _bin(self, chrom, start, end):
+
+        key = (chrom, start, end)
+        if key in self.bins:
+            return self.bins[key]
+        seg_start, seg_end = self.chromosome(chrom)[:2]
+        lo_ = np.searchsorted(seg_end, start, side='right')
+        hi_ = np.searchsorted(seg_start, end, side='left')
+        starts = np.maximum(seg_start[lo_:hi_], start)
+        lengths = np.minimum(seg_end[lo_:hi_], end) - starts
+        value = (lo_, starts, np.cumsum(lengths), lengths)
+        if len(self.bins) >= self.cache_size:
+            self.bins.clear()
+        self.bins[key] = value
+
+        return value
+
+    def draw(self, chrom, start, end, n):
+        """
+        Draw n positions uniformly from the mappable part of [start, end) on
+        a source chromosome. Returns the target chromosome codes (indices into
+        self.target_names) and target positions, or None if nothing in the
+        interval is uniquely mappable.
+        """
+        lo_, starts, cum, lengths = self._bin(chrom, start, end)
+        if (not len(cum)) or (cum[-1] == 0):
+            return None
+        x = self.rng.integers(0, cum[-1], size=n)
+        k = np.searchsorted(cum, x, side='right')
+        pos = starts[k] + x - (cum[k] - lengths[k])
+        _, _, shift, minus, tsize, tcode = self.segments[chrom]
+        idx = lo_ + k
+        pos = pos + shift[idx]
+        pos = np.where(minus[idx], tsize[idx] - 1 - pos, pos)
+
+        return tcode[idx], pos
+
+def _pixel_to_reads(outstream, line, chrom_index, mapping_table, lo, resolution, source, total_count, mapped_count,
+    sampler=None):
 
     if source == 'cooler':
         parse = line.decode().rstrip().split()
@@ -193,7 +702,23 @@ def _pixel_to_reads(outstream, line, chrom_index, mapping_table, lo, resolution,
 
     total_count += v
     
-    if not lo is None:
+    if (not lo is None) and (not sampler is None) and (mapping_table is None):
+        # all contacts of the pixel are drawn at once within the mappable space
+        hits1 = sampler.draw(c1_, s1_, e1_, v)
+        hits2 = sampler.draw(c2_, s2_, e2_, v)
+        if (hits1 is None) or (hits2 is None):
+            return total_count, mapped_count
+        names = sampler.target_names
+        t1, p1 = hits1
+        t2, p2 = hits2
+        r1, r2 = sampler.target_rank[t1], sampler.target_rank[t2]
+        swap = (r1 > r2) | ((r1 == r2) & (p1 > p2))
+        t1, t2 = np.where(swap, t2, t1), np.where(swap, t1, t2)
+        p1, p2 = np.where(swap, p2, p1), np.where(swap, p1, p2)
+        for a, x, b, y in zip(t1.tolist(), p1.tolist(), t2.tolist(), p2.tolist()):
+            _write_pair(outstream, ['.', names[a], x, names[b], y, '.', '.'])
+        mapped_count += v
+    elif not lo is None:
         for _ in range(v):
             for i in range(100):
                 p1_ = random.randint(s1_, e1_)
@@ -206,8 +731,8 @@ def _pixel_to_reads(outstream, line, chrom_index, mapping_table, lo, resolution,
                     continue
                 if not has_correct_order(hit1, hit2, chrom_index):
                     hit1, hit2 = hit2, hit1
-                cols = ['.', hit1[0], str(hit1[1]), hit2[0], str(hit2[1]), '.', '.']
-                outstream.write('\t'.join(cols) + '\n')
+                cols = ['.', hit1[0], hit1[1], hit2[0], hit2[1], '.', '.']
+                _write_pair(outstream, cols)
                 mapped_count += 1
                 break
     else:
@@ -222,9 +747,74 @@ def _pixel_to_reads(outstream, line, chrom_index, mapping_table, lo, resolution,
         if not has_correct_order(hit1, hit2, chrom_index):
             hit1, hit2 = hit2, hit1
 
+        cols = ['.', hit1[0], hit1[1], hit2[0], hit2[1], '.', '.']
         for _ in range(v):
-            cols = ['.', hit1[0], str(hit1[1]), hit2[0], str(hit2[1]), '.', '.']
-            outstream.write('\t'.join(cols) + '\n')
+            _write_pair(outstream, cols)
+
+    return total_count, mapped_count
+
+def _lift_shards(index, chroms, positions, executor=None):
+    """
+    Lift positions sharded by source chromosome: each shard is looked up in
+    the segment arrays of its chromosome, in parallel if an executor is given.
+    """
+    codes = np.zeros(len(positions), dtype=np.int64)
+    lifted = np.zeros(len(positions), dtype=np.int64)
+    mapped = np.zeros(len(positions), dtype=bool)
+    shards = {}
+    for i, c in enumerate(chroms):
+        shards.setdefault(c, []).append(i)
+    for c in shards:
+        # segments are built serially, lookups only read them
+        index.chromosome(c)
+    shards = [(c, np.array(rows)) for c, rows in shards.items()]
+    if executor is None:
+        results = [index.lift(c, positions[rows]) for c, rows in shards]
+    else:
+        results = list(executor.map(lambda shard: index.lift(shard[0], positions[shard[1]]), shards))
+    for (_, rows), (code, pos, ok) in zip(shards, results):
+        codes[rows] = code
+        lifted[rows] = pos
+        mapped[rows] = ok
+
+    return codes, lifted, mapped
+
+def _pairs_write_batch(outstream, lines, chrom_index, index, source, total_count, mapped_count, executor=None):
+    """
+    Lift a batch of pairs lines at once with a MappableIndex, equivalent to
+    calling _pairs_write on every line. Output lines keep the input order.
+    """
+    rows = [l.rstrip().split() for l in lines]
+    rows = [r for r in rows if len(r)]
+    if not len(rows):
+        return total_count, mapped_count
+    if source == 'hic-pro':
+        cols = (0, 1, 2, 4, 5, 3, 6)
+    else:
+        cols = (0, 1, 2, 3, 4, 5, 6)
+    rows = [[r[i] for i in cols] for r in rows]
+    total_count += len(rows)
+
+    c1 = ['chr' + r[1].lstrip('chr') for r in rows]
+    c2 = ['chr' + r[3].lstrip('chr') for r in rows]
+    p1 = np.array([int(r[2]) for r in rows], dtype=np.int64)
+    p2 = np.array([int(r[4]) for r in rows], dtype=np.int64)
+    t1, p1, ok1 = _lift_shards(index, c1, p1, executor)
+    t2, p2, ok2 = _lift_shards(index, c2, p2, executor)
+    r1, r2 = index.target_rank[t1], index.target_rank[t2]
+    swap = (r1 > r2) | ((r1 == r2) & (p1 > p2))
+    t1, t2 = np.where(swap, t2, t1), np.where(swap, t1, t2)
+    p1, p2 = np.where(swap, p2, p1), np.where(swap, p1, p2)
+
+    names = index.target_names
+    kept = np.flatnonzero(ok1 & ok2)
+    for i, a, x, b, y, flip in zip(kept.tolist(), t1[kept].tolist(), p1[kept].tolist(), t2[kept].tolist(),
+                                   p2[kept].tolist(), swap[kept].tolist()):
+        readID, strand1, strand2 = rows[i][0], rows[i][5], rows[i][6]
+        if flip:
+            strand1, strand2 = strand2, strand1
+        _write_pair(outstream, [readID, names[a], x, names[b], y, strand1, strand2])
+    mapped_count += len(kept)
 
     return total_count, mapped_count
 
@@ -258,8 +848,8 @@ def _pairs_write(outstream, line, chrom_index, mapping_table, lo, resolution, so
             hit1, hit2 = hit2, hit1
             strand1, strand2 = strand2, strand1
         
-        cols = [readID, hit1[0], str(hit1[1]), hit2[0], str(hit2[1]), strand1, strand2]
-        outstream.write('\t'.join(cols) + '\n')
+        cols = [readID, hit1[0], hit1[1], hit2[0], hit2[1], strand1, strand2]
+        _write_pair(outstream, cols)
     else:
         if (not c1_ in chrom_index) or (not c2_ in chrom_index):
             return total_count, mapped_count
@@ -270,8 +860,8 @@ def _pairs_write(outstream, line, chrom_index, mapping_table, lo, resolution, so
             hit1, hit2 = hit2, hit1
             strand1, strand2 = strand2, strand1
 
-        cols = [readID, hit1[0], str(hit1[1]), hit2[0], str(hit2[1]), strand1, strand2]
-        outstream.write('\t'.join(cols) + '\n')
+        cols = [readID, hit1[0], hit1[1], hit2[0], hit2[1], strand1, strand2]
+        _write_pair(outstream, cols)
 
     mapped_count += 1
 
@@ -8,11 +8,12 @@ with a C-based IntervalTree for accelerating the computation.
 
 import os
 import gzip
-from HiCLift.chainfile import open_liftover_chain_file, LiftOverChainFile
+from HiCLift.chainfile import open_liftover_chain_file, open_composed_chain_file, LiftOverChainFile
 
 class LiftOver:
     def __init__(self, from_db, to_db=None, search_dir='.', cache_dir=os.path.expanduser("~/.pyliftover"),
-        use_web=True, write_cache=True, use_gzip=None):
+        use_web=True, write_cache=True, use_gzip=None, via_db=None,
+        chroms=None, lazy=True):
         '''
         LiftOver can be initialized in multiple ways.
          * By providing a filename as a single argument: LiftOver("hg17ToHg18.over.chain.gz")
@@ -24,6 +25,18 @@ class LiftOver:
            The file will be searched in local directory, cache directory, or even downloaded from the web, if possible.
            The exact way this is handled (as well as all the other parameters of the constructor) is documented in 
            :see:`pyliftover.chainfile.open_liftover_chain_file`.
+         * By providing a list of chain files as a single argument, e.g.
+           LiftOver(["hg19ToHg38.over.chain.gz", "hg38ToHs1.over.chain.gz"]), or the names of
+           from_db, via_db and to_db, e.g. LiftOver('hg19', 'hs1', via_db='hg38').
+           The chains are composed into a single hg19 -> hs1 chain file, which is cached in
+           cache_dir, so that multi-hop conversions only need one pass over the data
+           (see :see:`HiCLift.chainfile.open_composed_chain_file`).
+
+        By default (lazy=True), chains of a source chromosome are only parsed and indexed
+        the first time a position on that chromosome is converted. If chroms is given,
+        chains on other source chromosomes are never loaded, and positions on them
+        are treated as unknown (None is returned). With lazy=False, all chains are
+        indexed right away.
         
         Test providing filename:
         >>> lo = LiftOver('tests/data/mds42.to.mg1655.liftOver')
@@ -47,7 +60,9 @@ class LiftOver:
         '''
         if to_db is None:
             # A file name or a file object was provided
-            if isinstance(from_db, str):
+            if isinstance(from_db, (list, tuple)):
+                f = open_composed_chain_file(list(from_db), cache_dir=cache_dir, write_cache=write_cache)
+            elif isinstance(from_db, str):
                 do_gzip = use_gzip if use_gzip is not None else from_db.lower().endswith('.gz')
                 if do_gzip:
                     f = gzip.open(from_db, 'rb')
@@ -55,12 +70,20 @@ class LiftOver:
                     f = open(from_db, 'rb')
             else:
                 f = from_db
+        elif via_db is not None:
+            hops = [open_liftover_chain_file(from_db=from_db, to_db=via_db, search_dir=search_dir,
+                                             cache_dir=cache_dir, use_web=use_web, write_cache=write_cache),
+                    open_liftover_chain_file(from_db=via_db, to_db=to_db, search_dir=search_dir,
+                                             cache_dir=cache_dir, use_web=use_web, write_cache=write_cache)]
+            if None in hops:
+                raise Exception("Could not obtain the chain files for {0} -> {1} -> {2}".format(from_db, via_db, to_db))
+            f = open_composed_chain_file(hops, cache_dir=cache_dir, write_cache=write_cache)
         else:
             # From- and To- db names were provided.
             f = open_liftover_chain_file(from_db=from_db, to_db=to_db, search_dir=search_dir,
                                          cache_dir=cache_dir, use_web=use_web, write_cache=write_cache)
 
-        self.chain_file = LiftOverChainFile(f)
+        self.chain_file = LiftOverChainFile(f, chroms=chroms, lazy=lazy)
         f.close()
         
     def convert_coordinate(self, chromosome, position, strand='+'):
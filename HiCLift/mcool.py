@@ -0,0 +1,260 @@
+'''
+In-process multi-resolution aggregation of a base-resolution cool file.
+
+Pixels of the base matrix are read once, in row blocks aligned to all the
+requested resolutions, and coarsened to every resolution in the same pass.
+Blocks are processed in parallel, and the coarsened pixels are written
+straight into the .mcool file.
+
+'''
+
+import os, shutil, tempfile, logging
+from functools import reduce
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import cooler, h5py
+
+log = logging.getLogger(__name__)
+
+def _lcm(a, b):
+
+    a, b = int(a), int(b)
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+
+    return a // x * b
+
+def _chrom_offsets(chromsizes, binsize):
+
+    nbins = (np.asarray(chromsizes, dtype=np.int64) + binsize - 1) // binsize
+
+    return np.r_[0, np.cumsum(nbins)]
+
+def _bin_records(records, offsets, binsize):
+
+    n = offsets[-1]
+    bin1 = offsets[records['chrom1'] - 1] + records['pos1'] // binsize
+    bin2 = offsets[records['chrom2'] - 1] + records['pos2'] // binsize
+    uniq, counts = np.unique(bin1 * n + bin2, return_counts=True)
+
+    return uniq // n, uniq % n, counts
+
+def _bin_shard(args):
+
+    path, offsets, binsize, workdir, chunksize = args
+    records = np.load(path, mmap_mode='r')
+    prefix = os.path.join(workdir, os.path.basename(path))
+    outfiles = []
+    for i, lo in enumerate(range(0, len(records), chunksize)):
+        bin1, bin2, counts = _bin_records(np.array(records[lo:lo+chunksize]), offsets, binsize)
+        fil = '{0}.{1}.npz'.format(prefix, i)
+        np.savez(fil, bin1=bin1, bin2=bin2, count=counts)
+        outfiles.append(fil)
+
+    return outfiles
+
+def shards_to_cool(paths, cool_uri, chromsizes, binsize, assembly=None, tmpdir=None, nproc=1, chunksize=10000000):
+    """
+    Bin shards of binary pairs records (see HiCLift.shards) into a cooler.
+    Shards are binned in parallel into temporary pixel chunks, which are
+    then written in the order of the shards.
+    """
+    chromsizes = pd.Series([l for _, l in chromsizes], index=[c for c, _ in chromsizes])
+    bins = cooler.binnify(chromsizes, binsize)
+    offsets = _chrom_offsets(chromsizes.values, binsize)
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    tasks = [(path, offsets, binsize, workdir, chunksize) for path in paths]
+
+    def _chunks(results):
+        for outfiles in results:
+            for fil in outfiles:
+                data = np.load(fil)
+                yield pd.DataFrame({'bin1_id': data['bin1'], 'bin2_id': data['bin2'], 'count': data['count']})
+                data.close()
+                os.remove(fil)
+
+    pool = Pool(nproc) if nproc > 1 else None
+    try:
+        results = pool.imap(_bin_shard, tasks) if not pool is None else map(_bin_shard, tasks)
+        cooler.create_cooler(cool_uri, bins, _chunks(results), assembly=assembly, ordered=False,
+                             symmetric_upper=True, dtypes={'count': np.int32}, temp_dir=tmpdir)
+    finally:
+        if not pool is None:
+            pool.close()
+    shutil.rmtree(workdir)
+
+def pairs_to_cool(blocks, cool_uri, chromsizes, binsize, assembly=None, tmpdir=None):
+    """
+    Bin blocks of binary pairs records (see HiCLift.io.PAIRS_DTYPE) into a cooler.
+
+    chromsizes is a list of (chrom, length), in the order that defines the
+    chromosome codes of the records.
+    """
+    chromsizes = pd.Series([l for _, l in chromsizes], index=[c for c, _ in chromsizes])
+    bins = cooler.binnify(chromsizes, binsize)
+    offsets = _chrom_offsets(chromsizes.values, binsize)
+
+    def _chunks():
+        for block in blocks:
+            bin1, bin2, counts = _bin_records(block, offsets, binsize)
+            yield pd.DataFrame({'bin1_id': bin1, 'bin2_id': bin2, 'count': counts})
+
+    # records are sorted by chromosome pair first, so pixels are not ordered by bin1_id
+    cooler.create_cooler(cool_uri, bins, _chunks(), assembly=assembly, ordered=False, symmetric_upper=True,
+                         dtypes={'count': np.int32}, temp_dir=tmpdir)
+
+def row_blocks(clr, align, chunksize=10000000):
+    """
+    Split the rows of a cooler into (lo, hi) pixel ranges. Block boundaries
+    never fall inside a chromosome bin of size *align* (in base pairs), and
+    each block holds about *chunksize* pixels.
+    """
+    step = align // clr.binsize
+    chrom_offset = clr._load_dset('indexes/chrom_offset')
+    bin1_offset = clr._load_dset('indexes/bin1_offset')
+    blocks = []
+    for i in range(len(chrom_offset) - 1):
+        start, end = chrom_offset[i], chrom_offset[i+1]
+        lo = start
+        for b in range(start + step, end + step, step):
+            b = min(b, end)
+            if (bin1_offset[b] - bin1_offset[lo] >= chunksize) or (b == end):
+                if bin1_offset[b] > bin1_offset[lo]:
+                    blocks.append((int(bin1_offset[lo]), int(bin1_offset[b])))
+                lo = b
+
+    return blocks
+
+def _coarsen_block(args):
+
+    uri, lo, hi, base_offsets, targets = args
+    clr = cooler.Cooler(uri)
+    pixels = clr.pixels(join=False)[lo:hi]
+    bin1 = pixels['bin1_id'].values
+    bin2 = pixels['bin2_id'].values
+    count = pixels['count'].values
+
+    chrom1 = np.searchsorted(base_offsets, bin1, side='right') - 1
+    chrom2 = np.searchsorted(base_offsets, bin2, side='right') - 1
+    rel1 = bin1 - base_offsets[chrom1]
+    rel2 = bin2 - base_offsets[chrom2]
+
+    coarsened = {}
+    for res, factor, offsets in targets:
+        n = offsets[-1]
+        key = (offsets[chrom1] + rel1 // factor) * n + (offsets[chrom2] + rel2 // factor)
+        uniq, inv = np.unique(key, return_inverse=True)
+        total = np.bincount(inv, weights=count).astype(count.dtype)
+        coarsened[res] = (uniq // n, uniq % n, total)
+
+    return coarsened
+
+def balance(uri, nproc=1):
+    """
+    Matrix balancing with the default parameters of "cooler balance".
+    """
+    clr = cooler.Cooler(uri)
+    if nproc > 1:
+        pool = Pool(nproc)
+        map_ = pool.map
+    else:
+        pool = None
+        map_ = map
+    try:
+        cooler.balance_cooler(clr, chunksize=10000000, map=map_, mad_max=5, min_nnz=10,
+                              ignore_diags=2, store=True)
+    finally:
+        if not pool is None:
+            pool.close()
+
+def zoomify(base_uri, out_path, resolutions, nproc=1, balance_matrix=True, tmpdir=None,
+    chunksize=10000000):
+    """
+    Build a multi-resolution .mcool file from a base-resolution cooler.
+
+    Parameters
+    ----------
+    base_uri : str
+        URI of the base cooler. Every resolution must be a multiple of
+        its bin size.
+
+    out_path : str
+        Path to the output .mcool file.
+
+    resolutions : list of int
+        Resolutions to generate (the base resolution may be included).
+
+    nproc : int
+        Number of processes used to coarsen row blocks and to balance.
+
+    balance_matrix : bool
+        Whether to balance the matrices at every resolution.
+
+    tmpdir : str
+        Folder for the temporary coarsened pixel chunks.
+    """
+    clr = cooler.Cooler(base_uri)
+    base = clr.binsize
+    resolutions = sorted(set(int(r) for r in resolutions) | {base})
+    for res in resolutions:
+        if res % base != 0:
+            raise ValueError('Resolution {0} is not a multiple of the base resolution {1}'.format(res, base))
+
+    chromsizes = clr.chromsizes
+    base_offsets = _chrom_offsets(chromsizes.values, base)
+    targets = [(res, res // base, _chrom_offsets(chromsizes.values, res)) for res in resolutions[1:]]
+    align = reduce(_lcm, resolutions)
+    blocks = row_blocks(clr, align, chunksize=chunksize)
+    assembly = clr.info.get('genome-assembly')
+    with clr.open('r') as grp:
+        count_dtype = grp['pixels']['count'].dtype
+
+    # the base resolution is copied over chunk by chunk
+    log.info('Writing the base resolution {0} ...'.format(base))
+    bins = clr.bins()[['chrom', 'start', 'end']][:]
+    pixels = (clr.pixels(join=False)[lo:hi] for lo, hi in blocks)
+    cooler.create_cooler('{0}::resolutions/{1}'.format(out_path, base), bins, pixels, assembly=assembly,
+                         ordered=True, symmetric_upper=True, dtypes={'count': count_dtype},
+                         mode='w')
+
+    if len(targets):
+        log.info('Coarsening to {0} ...'.format(','.join(map(str, resolutions[1:]))))
+        workdir = tempfile.mkdtemp(dir=tmpdir)
+        tasks = [(base_uri, lo, hi, base_offsets, targets) for lo, hi in blocks]
+        pool = Pool(nproc) if nproc > 1 else None
+        try:
+            results = pool.imap(_coarsen_block, tasks) if not pool is None else map(_coarsen_block, tasks)
+            for i, coarsened in enumerate(results):
+                for res in coarsened:
+                    bin1, bin2, count = coarsened[res]
+                    np.savez(os.path.join(workdir, '{0}.{1}.npz'.format(res, i)), bin1=bin1, bin2=bin2, count=count)
+        finally:
+            if not pool is None:
+                pool.close()
+
+        def _chunks(res):
+            for i in range(len(blocks)):
+                fil = os.path.join(workdir, '{0}.{1}.npz'.format(res, i))
+                data = np.load(fil)
+                yield pd.DataFrame({'bin1_id': data['bin1'], 'bin2_id': data['bin2'], 'count': data['count']})
+                data.close()
+                os.remove(fil)
+
+        for res, _, _ in targets:
+            bins = cooler.binnify(chromsizes, res)
+            cooler.create_cooler('{0}::resolutions/{1}'.format(out_path, res), bins, _chunks(res),
+                                 assembly=assembly, ordered=True, symmetric_upper=True,
+                                 dtypes={'count': count_dtype}, mode='a')
+
+        shutil.rmtree(workdir)
+
+    with h5py.File(out_path, 'r+') as f:
+        f.attrs['format'] = 'HDF5::MCOOL'
+        f.attrs['format-version'] = 2
+
+    if balance_matrix:
+        for res in resolutions:
+            log.info('Balancing the matrix at resolution {0} ...'.format(res))
+            balance('{0}::resolutions/{1}'.format(out_path, res), nproc=nproc)
@@ -0,0 +1,165 @@
+'''
+Checkpointed, resumable conversion through per chromosome pair shards.
+
+Lifted pairs are written as binary records (see HiCLift.io.PAIRS_DTYPE) into
+one shard per (chrom1, chrom2), as sorted parts that are merged into every
+shard on its own, with bounded memory. The completed stages and sorted shards
+are recorded in a checkpoint file, so re-running an interrupted job skips the
+finished work, and the output stages consume the shards in parallel.
+
+'''
+
+import os, glob, json, shutil, logging
+from multiprocessing import Pool
+import numpy as np
+from HiCLift.io import PAIRS_DTYPE, merge_binary_runs, write_binary_pairs
+
+log = logging.getLogger(__name__)
+
+class Checkpoint:
+    """
+    Completed stages of a sharded conversion, stored in
+    "{workdir}/checkpoint.json".
+
+    A checkpoint written for a different *job* (any JSON-serializable
+    description of the inputs and settings) is discarded together with the
+    content of *workdir*.
+    """
+    def __init__(self, workdir, job):
+
+        self.workdir = workdir
+        self.path = os.path.join(workdir, 'checkpoint.json')
+        job = json.loads(json.dumps(job))
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if state['job'] != job:
+                log.info('{0} was written for a different job, starting over ...'.format(self.path))
+                state = None
+            else:
+                log.info('Resuming from {0}, completed stages: {1}'.format(self.path, ', '.join(state['stages']) or 'none'))
+        if state is None:
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            os.makedirs(workdir)
+            state = {'job': job, 'stages': [], 'shards': {}, 'sorted': []}
+        self.state = state
+        self._save()
+
+    def _save(self):
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+    def done(self, stage):
+
+        return stage in self.state['stages']
+
+    def finish(self, stage, **values):
+        """
+        Record a completed stage, and optionally update the stored values.
+        """
+        self.state.update(values)
+        self.state['stages'].append(stage)
+        self._save()
+
+    def shard_sorted(self, name):
+
+        self.state['sorted'].append(name)
+        self._save()
+
+    def clear(self):
+        """
+        Remove everything but the checkpoint file from the working folder.
+        """
+        for fil in os.listdir(self.workdir):
+            if fil != os.path.basename(self.path):
+                os.remove(os.path.join(self.workdir, fil))
+
+    def remove(self):
+
+        shutil.rmtree(self.workdir)
+
+def shard_path(workdir, name):
+
+    return os.path.join(workdir, '{0}.npy'.format(name))
+
+def shard_codes(name):
+
+    return tuple(int(c) for c in name.split('-'))
+
+def _sort_shard(args):
+
+    workdir, name, count, memory = args
+    parts = sorted(glob.glob(os.path.join(workdir, '{0}.part*.npy'.format(name))))
+    dest = shard_path(workdir, name)
+    if os.path.exists(dest) and (len(np.load(dest, mmap_mode='r')) == count):
+        # merged by a previous run, which stopped before removing the parts or
+        # recording the shard
+        for p in parts:
+            os.remove(p)
+        return name
+    if len(parts) == 1:
+        os.replace(parts[0], dest)
+        return name
+    # every part is a sorted run, merged with one buffer per part (the merged
+    # block and its sorted copy take about as much again)
+    count = sum(len(np.load(p, mmap_mode='r')) for p in parts)
+    blocksize = max(1000, int(memory // (3 * len(parts) * PAIRS_DTYPE.itemsize)))
+    tmp = os.path.join(workdir, '{0}.tmp.npy'.format(name))
+    write_binary_pairs(tmp, merge_binary_runs(parts, blocksize=blocksize), count)
+    os.replace(tmp, dest)
+    for p in parts:
+        os.remove(p)
+
+    return name
+
+def sort_shards(checkpoint, nproc=1, memory=4*1024**3):
+    """
+    Merge the sorted parts of every shard not sorted yet into "{name}.npy", in
+    parallel, recording each sorted shard in the checkpoint. The merge buffers
+    of the *nproc* workers take about *memory* bytes in total, whatever the
+    size of the shards.
+    """
+    pending = [n for n in checkpoint.state['shards'] if not n in checkpoint.state['sorted']]
+    # largest shards first, so that the pool stays busy
+    pending.sort(key=lambda n: checkpoint.state['shards'][n], reverse=True)
+    tasks = [(checkpoint.workdir, n, checkpoint.state['shards'][n], memory / max(nproc, 1)) for n in pending]
+    if nproc > 1:
+        pool = Pool(nproc)
+        results = pool.imap_unordered(_sort_shard, tasks)
+    else:
+        pool = None
+        results = map(_sort_shard, tasks)
+    try:
+        for name in results:
+            checkpoint.shard_sorted(name)
+    finally:
+        if not pool is None:
+            pool.close()
+
+def ordered_shards(checkpoint, chrom_names=None):
+    """
+    Paths of the sorted shards, in the order of the chromosome codes, or in the
+    order of the chromosome names (as in sorted .pairs files) if the names
+    (in code order) are given.
+    """
+    names = list(checkpoint.state['shards'])
+    if chrom_names is None:
+        names.sort(key=shard_codes)
+    else:
+        names.sort(key=lambda n: tuple(chrom_names[c - 1] for c in shard_codes(n)))
+
+    return [shard_path(checkpoint.workdir, n) for n in names]
+
+def shard_blocks(paths, blocksize=1000000):
+    """
+    Yield blocks of records from sorted shards, one shard after another.
+    """
+    for path in paths:
+        records = np.load(path, mmap_mode='r')
+        for i in range(0, len(records), blocksize):
+            yield np.array(records[i:i+blocksize])
@@ -1,9 +1,17 @@
-import subprocess, sys, os, io, logging, cooler, HiCLift
+import subprocess, sys, os, io, logging, hashlib, json, random, itertools, cooler, h5py, HiCLift
+from concurrent.futures import ThreadPoolExecutor
 from HiCLift.liftover import LiftOver
-from HiCLift.io import open_pairs, _pixel_to_reads, _pairs_write
+from HiCLift.mcool import zoomify, balance, pairs_to_cool, shards_to_cool
+from HiCLift.shards import Checkpoint, sort_shards, ordered_shards, shard_blocks
+from HiCLift.hic import write_hic, write_hic_binary
+from HiCLift.io import open_pairs, _pixel_to_reads, _pairs_write, BoundedWindowSorter, merge_sorted_pairs, \
+    write_text_pairs, write_binary_pairs, MappableIndex, ShardedPairsWriter, _pairs_write_batch
 
 log = logging.getLogger(__name__)
 
+# buffer size of the external sort of the text intermediate
+SORT_BUFFER = '8G'
+
 def get_chrom_order(chroms_file):
     """
     Produce an "enumeration" of chromosomes based on the list
@@ -84,6 +92,17 @@ def get_header(instream, comment_char='#'):
     # return header and the instream, advanced to the beginning of the data
     return header, instream
 
+def is_sorted_pairs(header):
+    """
+    Check whether the "#sorted:" field of a pairs header declares the
+    standard chr1-chr2-pos1-pos2 order.
+    """
+    for line in header:
+        if line.startswith('#sorted:'):
+            return line.split(':', 1)[1].strip() == 'chr1-chr2-pos1-pos2'
+    
+    return False
+
 def extract_chrom_sizes(fil):
 
     chromsizes = []
@@ -94,6 +113,30 @@ def extract_chrom_sizes(fil):
     
     return chromsizes
 
+def parse_size(memory):
+    """
+    Number of bytes of a size string such as "8G" (as for "sort -S").
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    memory = str(memory).upper().rstrip('B')
+    if memory[-1:] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+
+    return float(memory)
+
+def get_resolutions(resolutions=None, high_res=False):
+    """
+    Sorted resolutions of the output contact matrices, the defaults if none
+    are given.
+    """
+    if resolutions is None:
+        if high_res:
+            resolutions = [1000, 2000, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000]
+        else:
+            resolutions = [5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000]
+
+    return sorted(resolutions)
+
 def make_mapping_table(chroms_path, lo, resolution=200):
 
     chromsizes = extract_chrom_sizes(chroms_path)
@@ -110,9 +153,291 @@ def make_mapping_table(chroms_path, lo, resolution=200):
     
     return D
 
+def _digest(paths):
+
+    md5 = hashlib.md5()
+    for path in paths:
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(1<<20), b''):
+                md5.update(chunk)
+    
+    return md5.hexdigest()
+
+def make_manifest(in_path, in_assembly, out_assembly, out_chroms, chain_file=None, via_assembly=None):
+    """
+    Provenance of a HiCLift output: the assemblies, digests of the chain
+    file(s) and the target chromosome sizes, and the list of inputs.
+    """
+    if chain_file is None:
+        chain = None
+    elif isinstance(chain_file, (list, tuple)):
+        chain = _digest(chain_file)
+    else:
+        chain = _digest([chain_file])
+    
+    manifest = {
+        'in_assembly': in_assembly,
+        'out_assembly': out_assembly,
+        'via_assembly': via_assembly,
+        'chain': chain,
+        'chromsizes': _digest([out_chroms]),
+        'inputs': [os.path.basename(in_path)]
+    }
+
+    return manifest
+
+def read_manifest(path):
+    """
+    Read the provenance manifest from a .pairs.gz or .mcool file produced
+    by HiCLift. Returns None if no manifest can be found.
+    """
+    if path.endswith('.mcool'):
+        with h5py.File(path, 'r') as f:
+            value = f.attrs.get('HiCLift-manifest')
+        if value is None:
+            return
+        return json.loads(value)
+    else:
+        instream = open_pairs(path, mode='r')
+        header, _ = get_header(instream)
+        instream.close()
+        for line in header:
+            if line.startswith('#HiCLift-manifest:'):
+                return json.loads(line.split(':', 1)[1])
+
+def check_manifest(previous, current):
+    """
+    Make sure new pairs are lifted in the same way as the existing output,
+    and return the manifest of the merged output.
+    """
+    for key in ['in_assembly', 'out_assembly', 'via_assembly', 'chain', 'chromsizes']:
+        if previous.get(key) != current.get(key):
+            raise ValueError('The existing output was generated with a different {0} ({1} vs {2})'.format(
+                key, previous.get(key), current.get(key)))
+    
+    merged = dict(current)
+    merged['inputs'] = previous['inputs'] + current['inputs']
+
+    return merged
+
+def list_resolutions(mcool):
+
+    with h5py.File(mcool, 'r') as f:
+        resolutions = sorted(int(r) for r in f['resolutions'])
+    
+    return resolutions
+
+def merge_mcool(old_path, new_path, out_path, nproc=1, balance_matrix=True):
+    """
+    Add up pixel counts of two .mcool files at every resolution, and
+    re-balance the merged matrices.
+    """
+    old_res = list_resolutions(old_path)
+    new_res = list_resolutions(new_path)
+    if old_res != new_res:
+        raise ValueError('Resolutions of {0} ({1}) and {2} ({3}) do not match'.format(
+            old_path, old_res, new_path, new_res))
+    
+    for i, res in enumerate(old_res):
+        uri = '{0}::resolutions/{1}'.format(out_path, res)
+        command = ['cooler', 'merge'] + (['--append'] if i > 0 else []) + [uri,
+                   '{0}::resolutions/{1}'.format(old_path, res),
+                   '{0}::resolutions/{1}'.format(new_path, res)]
+        subprocess.check_call(' '.join(command), shell=True)
+        if balance_matrix:
+            balance(uri, nproc=nproc)
+    # cooler merge does not mark the new file as a multi-resolution cooler
+    with h5py.File(out_path, 'r+') as f:
+        f.attrs['format'] = 'HDF5::MCOOL'
+        f.attrs['format-version'] = 2
+
+def load_liftover(in_assembly, out_assembly, chain_file, via_assembly=None, in_chroms=None):
+    """
+    Create the LiftOver object of a conversion, from the chain file(s) if given,
+    or from the chain files of the assemblies otherwise. The chains of a source
+    chromosome are only indexed when that chromosome is first queried.
+    """
+    # only load chains of the source chromosomes, if they are known
+    if not in_chroms is None:
+        source_chroms = [c for c, _ in extract_chrom_sizes(in_chroms)]
+    else:
+        source_chroms = None
+    if isinstance(chain_file, (list, tuple)) and (len(chain_file) == 1):
+        chain_file = chain_file[0]
+    if not chain_file is None:
+        if isinstance(chain_file, (list, tuple)):
+            log.info('Composing {0} chain files into a single chain file ...'.format(len(chain_file)))
+        lo = LiftOver(chain_file, chroms=source_chroms)
+    elif not via_assembly is None:
+        log.info('Composing chains {0} -> {1} -> {2} ...'.format(in_assembly, via_assembly, out_assembly))
+        lo = LiftOver(in_assembly, out_assembly, via_db=via_assembly, chroms=source_chroms)
+    else:
+        lo = LiftOver(in_assembly, out_assembly, chroms=source_chroms)
+
+    return lo
+
+def prepare_liftover(in_assembly, out_assembly, chain_file, chrom_index, via_assembly=None, in_chroms=None,
+    resolution=None, seed=None, nproc=1):
+    """
+    Returns the LiftOver object, the mapping table (if a resolution is given),
+    and the MappableIndex of a conversion; all of them are None if the two
+    assemblies are the same.
+    """
+    if in_assembly == out_assembly:
+        return None, None, None
+
+    lo = load_liftover(in_assembly, out_assembly, chain_file, via_assembly=via_assembly, in_chroms=in_chroms)
+    # build the mapping table at the given resolution
+    if not resolution is None:
+        log.info('Building the mapping table at the resolution: {0}'.format(resolution))
+        mapping_table = make_mapping_table(in_chroms, lo, resolution)
+        mappable = None
+    else:
+        mapping_table = None
+        # uniquely mappable segments of the source chromosomes, used to lift pairs
+        # by source chromosome, and to place the contacts of pixels within their bins
+        mappable = MappableIndex(lo, chrom_index, seed=seed)
+        if nproc > 1:
+            mappable.build_all(nproc=nproc)
+    random.seed(seed)
+
+    return lo, mapping_table, mappable
+
+def convert_contacts(body_stream, outstream, in_format, chrom_index, mapping_table, lo, resolution, mappable,
+    nproc=1, batchsize=100000):
+    """
+    Lift (or only convert) all contacts of an input stream into outstream.
+    Returns the total and the mapped numbers of contacts.
+    """
+    total_count = 0
+    mapped_count = 0
+    # pairs are lifted in batches, with the lookups sharded by source chromosome
+    executor = ThreadPoolExecutor(max_workers=nproc) if nproc > 1 else None
+    for line in body_stream:
+        if in_format in ['cooler', 'juicer']:
+            total_count, mapped_count = _pixel_to_reads(outstream,
+                                                        line,
+                                                        chrom_index,
+                                                        mapping_table,
+                                                        lo, resolution,
+                                                        in_format,
+                                                        total_count,
+                                                        mapped_count,
+                                                        sampler=mappable)
+        elif (in_format in ['pairs', 'hic-pro']) and (not mappable is None):
+            batch = [line] + list(itertools.islice(body_stream, batchsize - 1))
+            total_count, mapped_count = _pairs_write_batch(outstream,
+                                                           batch,
+                                                           chrom_index,
+                                                           mappable,
+                                                           in_format,
+                                                           total_count,
+                                                           mapped_count,
+                                                           executor=executor)
+        elif in_format in ['pairs', 'hic-pro']:
+            total_count, mapped_count = _pairs_write(outstream,
+                                                     line,
+                                                     chrom_index,
+                                                     mapping_table,
+                                                     lo, resolution,
+                                                     in_format,
+                                                     total_count,
+                                                     mapped_count)
+    if not executor is None:
+        executor.shutdown()
+
+    return total_count, mapped_count
+
+def _liftover_shards(convert, workdir, job, out_format, outfolder, out_pre, tmpdir, chromsizes, chrom_index,
+    header, manifest, out_assembly, resolutions, nproc, append_to=None, balance_matrix=True, memory='4G'):
+    """
+    Checkpointed conversion through per chromosome pair shards (see
+    HiCLift.shards). *convert* lifts the input into a ShardedPairsWriter.
+    Stages completed by a previous run of the same job are skipped.
+    """
+    checkpoint = Checkpoint(workdir, job)
+    if not checkpoint.done('convert'):
+        # an interrupted conversion is started over
+        checkpoint.clear()
+        writer = ShardedPairsWriter(workdir, chrom_index)
+        convert(writer)
+        writer.close()
+        checkpoint.finish('convert', shards=writer.shards)
+    if not checkpoint.done('sort'):
+        log.info('Sorting {0:,} shards ...'.format(len(checkpoint.state['shards'])))
+        sort_shards(checkpoint, nproc=nproc, memory=parse_size(memory))
+        checkpoint.finish('sort')
+
+    names = [c for c, _ in chromsizes]
+    if out_format == 'npy':
+        if not checkpoint.done('output'):
+            dest = os.path.join(outfolder, '{0}.pairs.npy'.format(out_pre))
+            log.info('Writing sorted binary pairs ...')
+            write_binary_pairs(dest, shard_blocks(ordered_shards(checkpoint)), sum(checkpoint.state['shards'].values()))
+            checkpoint.finish('output')
+    elif out_format == 'pairs':
+        if not checkpoint.done('output'):
+            out_path = os.path.join(workdir, '{0}.pairs.gz'.format(out_pre))
+            log.info('Writing sorted pairs ...')
+            outstream = open_pairs(out_path, mode='w', data_format='pairs', nproc=nproc)
+            outstream.writelines((l+'\n' for l in header))
+            # shards are concatenated in the order of the chromosome names, as in sorted .pairs files
+            write_text_pairs(outstream, shard_blocks(ordered_shards(checkpoint, names)), names)
+            outstream.close()
+            command = ['mv', out_path, os.path.join(outfolder, '{0}.pairs.gz'.format(out_pre))]
+            subprocess.check_call(' '.join(command), shell=True)
+            checkpoint.finish('output')
+    elif out_format == 'cool':
+        outmcool = os.path.join(outfolder, '{0}.mcool'.format(out_pre))
+        if append_to is None:
+            newmcool = outmcool
+        else:
+            newmcool = os.path.join(workdir, '{0}.new.mcool'.format(out_pre))
+        base = resolutions[0]
+        outcool = os.path.join(workdir, '{0}.{1}.cool'.format(out_pre, base))
+        if not checkpoint.done('cool'):
+            log.info('Binning the shards at {0} ...'.format(base))
+            shards_to_cool(ordered_shards(checkpoint), outcool, chromsizes, base, assembly=out_assembly,
+                           tmpdir=tmpdir, nproc=nproc)
+            checkpoint.finish('cool')
+        if not checkpoint.done('zoomify'):
+            log.info('Generate contact matrices at {0} ...'.format(','.join(map(str, resolutions[::-1]))))
+            zoomify(outcool, newmcool, resolutions, nproc=nproc, balance_matrix=False, tmpdir=tmpdir)
+            checkpoint.finish('zoomify')
+        if append_to is None:
+            for res in resolutions:
+                stage = 'balance:{0}'.format(res)
+                if balance_matrix and (not checkpoint.done(stage)):
+                    log.info('Balancing the matrix at resolution {0} ...'.format(res))
+                    balance('{0}::resolutions/{1}'.format(outmcool, res), nproc=nproc)
+                    checkpoint.finish(stage)
+        elif not checkpoint.done('merge'):
+            log.info('Adding up pixel counts with {0} ...'.format(append_to))
+            merged_mcool = os.path.join(workdir, '{0}.merged.mcool'.format(out_pre))
+            merge_mcool(append_to, newmcool, merged_mcool, nproc=nproc, balance_matrix=balance_matrix)
+            command = ['mv', merged_mcool, outmcool]
+            subprocess.check_call(' '.join(command), shell=True)
+            checkpoint.finish('merge')
+        with h5py.File(outmcool, 'r+') as f:
+            f.attrs['HiCLift-manifest'] = json.dumps(manifest)
+    else:
+        if not checkpoint.done('output'):
+            outhic = os.path.join(outfolder, '{0}.hic'.format(out_pre))
+            log.info('Generate contact matrices at {0} ...'.format(','.join(map(str, resolutions[::-1]))))
+            # every shard holds exactly one chromosome pair, as the .hic writer expects
+            write_hic_binary(shard_blocks(ordered_shards(checkpoint)), outhic, chromsizes, resolutions,
+                             genome=out_assembly, nproc=nproc)
+            checkpoint.finish('output')
+
+    checkpoint.remove()
+
 def liftover(in_path, out_pre, in_format, out_format, in_chroms, out_chroms, in_assembly, out_assembly,
-    chain_file, resolution=500, nproc_in=8, nproc_out=8, tmpdir='/tmp', memory='4G', high_res=False):
+    chain_file, resolution=500, nproc_in=8, nproc_out=8, tmpdir='/tmp', memory='4G', high_res=False,
+    via_assembly=None, sort_window=0, append_to=None, resolutions=None, balance_matrix=True,
+    hic_writer='native', intermediate='text', seed=None):
     
+    resolutions = get_resolutions(resolutions, high_res)
+
     tmpdir = os.path.abspath(os.path.expanduser(tmpdir))
     if not os.path.exists(tmpdir):
         os.makedirs(tmpdir)
@@ -120,9 +445,37 @@ def liftover(in_path, out_pre, in_format, out_format, in_chroms, out_chroms, in_
     outfolder, out_pre = os.path.split(out_pre)
     out_path = os.path.join(tmpdir, '{0}.pairs.gz'.format(out_pre))
 
-    instream = open_pairs(in_path, mode='r', data_format=in_format, nproc=nproc_in)
-    outstream = open_pairs(out_path, mode='w', data_format='pairs', nproc=nproc_out)
-    
+    manifest = make_manifest(in_path, in_assembly, out_assembly, out_chroms,
+                             chain_file=chain_file if in_assembly != out_assembly else None,
+                             via_assembly=via_assembly)
+    if not append_to is None:
+        # check the provenance of the existing output before doing any work
+        if (out_format == 'pairs') and (not append_to.endswith('.pairs.gz')):
+            raise ValueError('Only .pairs.gz files can be appended to with the pairs output format')
+        if (out_format == 'cool') and (not append_to.endswith('.mcool')):
+            raise ValueError('Only .mcool files can be appended to with the cool output format')
+        if out_format in ['hic', 'npy']:
+            raise ValueError('Appending to an existing .{0} file is not supported'.format(out_format))
+        previous = read_manifest(append_to)
+        if previous is None:
+            raise ValueError('{0} does not contain a HiCLift provenance manifest'.format(append_to))
+        manifest = check_manifest(previous, manifest)
+        if out_format == 'cool':
+            resolutions = list_resolutions(append_to)
+        log.info('Appending new pairs to {0} ...'.format(append_to))
+
+    sharded = intermediate == 'shards'
+    binary = intermediate in ['binary', 'shards']
+    if (out_format == 'npy') and (not binary):
+        raise ValueError('The npy output format requires the binary or shards intermediate')
+    if binary and (out_format == 'hic') and (hic_writer == 'juicer'):
+        raise ValueError('juicer_tools requires the text intermediate')
+    if sharded and (out_format == 'pairs') and (not append_to is None):
+        raise ValueError('Appending pairs is not supported with the shards intermediate')
+    if (out_format == 'hic') and (hic_writer == 'native'):
+        log.warning('The native .hic writer only stores VC normalization vectors; '
+                    'use --hic-writer juicer for KR normalization')
+
     # write header
     log.info('Writing headers ...')
     chromsizes = extract_chrom_sizes(out_chroms)
@@ -135,63 +488,115 @@ def liftover(in_path, out_pre, in_format, out_format, in_chroms, out_chroms, in_
         header.append('#HiCLift: coordinates transformed from {0}'.format(in_assembly))
     else:
         header.append('#HiCLift: pure data format conversion')
+    header.append('#HiCLift-manifest: {0}'.format(json.dumps(manifest)))
+    chrom_index = get_chrom_order(out_chroms)
+
+    if sharded:
+        def _convert(writer):
+            instream = open_pairs(in_path, mode='r', data_format=in_format, nproc=nproc_in)
+            if in_format in ['cooler', 'juicer']:
+                body_stream = instream
+            else:
+                _, body_stream = get_header(instream)
+            lo, mapping_table, mappable = prepare_liftover(in_assembly, out_assembly, chain_file, chrom_index,
+                                                           via_assembly=via_assembly, in_chroms=in_chroms,
+                                                           resolution=resolution, seed=seed, nproc=nproc_in)
+            log.info('Converting contact pairs into shards ...')
+            total_count, mapped_count = convert_contacts(body_stream, writer, in_format, chrom_index,
+                                                         mapping_table, lo, resolution, mappable, nproc=nproc_in)
+            if not lo is None:
+                log.info('{0:,} / {1:,} pairs were uniquely mapped to the target genome'.format(mapped_count, total_count))
+            if instream != sys.stdin:
+                instream.close()
+
+        input_file = in_path
+        if in_format == 'cooler':
+            # a cooler URI may point at a group inside the file
+            input_file = cooler.util.parse_cooler_uri(in_path)[0]
+        stat = os.stat(input_file)
+        job = {
+            'manifest': manifest,
+            'input': [os.path.abspath(in_path), stat.st_size, stat.st_mtime],
+            'in_format': in_format,
+            'out_format': out_format,
+            'resolution': resolution,
+            'resolutions': resolutions,
+            'balance': balance_matrix,
+            'append_to': append_to,
+            'seed': seed
+        }
+        workdir = os.path.join(tmpdir, '{0}.shards'.format(out_pre))
+        _liftover_shards(_convert, workdir, job, out_format, outfolder, out_pre, tmpdir, chromsizes, chrom_index,
+                         header, manifest, out_assembly, resolutions, nproc_out, append_to=append_to,
+                         balance_matrix=balance_matrix, memory=memory)
+        log.info('Done')
+        return
 
-    outstream.writelines((l+'\n' for l in header))
-    outstream.flush()
+    instream = open_pairs(in_path, mode='r', data_format=in_format, nproc=nproc_in)
+    if not binary:
+        outstream = open_pairs(out_path, mode='w', data_format='pairs', nproc=nproc_out)
+        outstream.writelines((l+'\n' for l in header))
+        outstream.flush()
     
-    chrom_index = get_chrom_order(out_chroms)
     if in_format in ['cooler', 'juicer']:
+        in_header = []
         body_stream = instream
     else:
-        _, body_stream = get_header(instream)
+        in_header, body_stream = get_header(instream)
+    presorted = (not binary) and (in_format == 'pairs') and bool(sort_window) and is_sorted_pairs(in_header)
     
     # sort command
     command = r'''/bin/bash -c 'export LC_COLLATE=C; export LANG=C; sort -k 2,2 -k 4,4 -k 3,3n -k 5,5n --stable {0} {1} -S {2} {3}'''.format(
-        '--parallel={0}'.format(nproc_out), '--temporary-directory={0}'.format(tmpdir), '8G', '--compress-program=lz4c'
+        '--parallel={0}'.format(nproc_out), '--temporary-directory={0}'.format(tmpdir), SORT_BUFFER, '--compress-program=lz4c'
     )
     command += "'"
 
-    if in_assembly != out_assembly:
-        # build the mapping table at the given resolution
-        if not chain_file is None:
-            lo = LiftOver(chain_file)
-        else:
-            lo = LiftOver(in_assembly, out_assembly)
-        if not resolution is None:
-            log.info('Building the mapping table at the resolution: {0}'.format(resolution))
-            mapping_table = make_mapping_table(in_chroms, lo, resolution)
-        else:
-            mapping_table = None
-        
+    lo, mapping_table, mappable = prepare_liftover(in_assembly, out_assembly, chain_file, chrom_index,
+                                                   via_assembly=via_assembly, in_chroms=in_chroms,
+                                                   resolution=resolution, seed=seed, nproc=nproc_in)
+    if not lo is None:
         log.info('Converting, sorting, and compressing ...')
     else:
-        lo = None
-        mapping_table = None
         log.info('Dumping contact pairs from {0} ...'.format(in_path))
 
-    total_count = 0
-    mapped_count = 0
-    with subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=-1, shell=True, stdout=outstream) as process:
+    if binary:
+        # lifted pairs are kept as sorted binary runs, and merged in-process; text
+        # pairs are sorted by chromosome names, as in the text and shards paths
+        if out_format == 'pairs':
+            binary_names = sorted(c for c, _ in chromsizes)
+        else:
+            binary_names = [c for c, _ in chromsizes]
+        stdin_wrapper = open_pairs(os.path.join(tmpdir, '{0}.pairs'.format(out_pre)), mode='w', data_format='binary',
+                                   chrom_index={c: i + 1 for i, c in enumerate(binary_names)})
+    elif presorted:
+        # keep in-order pairs in a sorted run, and only sort the out-of-order ones
+        log.info('The input pairs are sorted, using a window of {0:,} pairs to avoid the full sort ...'.format(sort_window))
+        run_path = os.path.join(tmpdir, '{0}.run.pairs.lz4'.format(out_pre))
+        runstream = open_pairs(run_path, mode='w')
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1, shell=True)
+        stdin_wrapper = BoundedWindowSorter(runstream, io.TextIOWrapper(process.stdin, 'utf-8'), window=sort_window)
+    else:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=-1, shell=True, stdout=outstream)
         stdin_wrapper = io.TextIOWrapper(process.stdin, 'utf-8')
-        for line in body_stream:
-            if in_format in ['cooler', 'juicer']:
-                total_count, mapped_count = _pixel_to_reads(stdin_wrapper,
-                                                            line,
-                                                            chrom_index,
-                                                            mapping_table,
-                                                            lo, resolution,
-                                                            in_format,
-                                                            total_count,
-                                                            mapped_count)
-            elif in_format in ['pairs', 'hic-pro']:
-                total_count, mapped_count = _pairs_write(stdin_wrapper,
-                                                         line,
-                                                         chrom_index,
-                                                         mapping_table,
-                                                         lo, resolution,
-                                                         in_format,
-                                                         total_count,
-                                                         mapped_count)
+    
+    total_count, mapped_count = convert_contacts(body_stream, stdin_wrapper, in_format, chrom_index,
+                                                 mapping_table, lo, resolution, mappable, nproc=nproc_in)
+    
+    if binary:
+        stdin_wrapper.close()
+    elif presorted:
+        stdin_wrapper.close()
+        runstream.close()
+        stdin_wrapper.spillstream.close()
+        log.info('{0:,} pairs were kept in order, {1:,} pairs were sorted externally'.format(stdin_wrapper.run_count,
+                                                                                            stdin_wrapper.spill_count))
+        log.info('Merging the sorted pairs ...')
+        runstream = open_pairs(run_path, mode='r')
+        merge_sorted_pairs(outstream, runstream, io.TextIOWrapper(process.stdout, 'utf-8'))
+        runstream.close()
+        process.wait()
+        os.remove(run_path)
+    else:
         stdin_wrapper.flush()
         process.communicate()
     
@@ -200,59 +605,98 @@ def liftover(in_path, out_pre, in_format, out_format, in_chroms, out_chroms, in_
 
     if instream != sys.stdin:
         instream.close()
-    if outstream != sys.stdout:
+    if binary:
+        pairs_blocks = stdin_wrapper
+        if out_format == 'pairs':
+            log.info('Writing sorted pairs ...')
+            outstream = open_pairs(out_path, mode='w', data_format='pairs', nproc=nproc_out)
+            outstream.writelines((l+'\n' for l in header))
+            write_text_pairs(outstream, pairs_blocks, binary_names)
+            outstream.close()
+    elif outstream != sys.stdout:
         outstream.close()
     
     # handle with different output formats
-    if out_format == 'pairs':
+    if out_format == 'npy':
+        dest = os.path.join(outfolder, '{0}.pairs.npy'.format(out_pre))
+        log.info('Writing sorted binary pairs ...')
+        write_binary_pairs(dest, pairs_blocks, pairs_blocks.count)
+    elif out_format == 'pairs':
         dest = os.path.join(outfolder, os.path.split(out_path)[1])
+        if not append_to is None:
+            log.info('Merging with {0} ...'.format(append_to))
+            merged_path = os.path.join(tmpdir, '{0}.merged.pairs.gz'.format(out_pre))
+            oldstream = open_pairs(append_to, mode='r', nproc=nproc_in)
+            _, old_body = get_header(oldstream)
+            newstream = open_pairs(out_path, mode='r', nproc=nproc_in)
+            _, new_body = get_header(newstream)
+            outstream = open_pairs(merged_path, mode='w', nproc=nproc_out)
+            outstream.writelines((l+'\n' for l in header))
+            merge_sorted_pairs(outstream, old_body, new_body)
+            oldstream.close()
+            newstream.close()
+            outstream.close()
+            os.remove(out_path)
+            out_path = merged_path
         command = ['mv', out_path, dest]
         subprocess.check_call(' '.join(command), shell=True)
     else:
-        command = ['pairix', out_path]
-        subprocess.check_call(' '.join(command), shell=True)
+        indexed = (not binary) and ((out_format == 'cool') or (hic_writer == 'juicer'))
+        if indexed:
+            command = ['pairix', out_path]
+            subprocess.check_call(' '.join(command), shell=True)
         if out_format == 'cool':
-            if high_res:
-                outcool = os.path.join(tmpdir, '{0}.{1}.cool'.format(out_pre, '1kb'))
-                bin_label = ':'.join([out_chroms, str(1000)])
-                log.info('Generate contact matrix using cooler at 2500000,1000000,500000,250000,100000,50000,25000,10000,5000,2000,1000 ...')
-                command = ['cooler', 'cload', 'pairix', '--assembly', out_assembly, '--nproc', str(nproc_out),
-                           '--max-split 12', bin_label, out_path, outcool]
-                subprocess.check_call(' '.join(command), shell=True)
-                outmcool = os.path.join(outfolder, '{0}.mcool'.format(out_pre))
-                command = ['cooler', 'zoomify', '-p', str(nproc_out), '-r 1000,2000,5000,10000,25000,50000,100000,250000,500000,1000000,2500000',
-                           '--balance', '-o', outmcool, outcool]
-                subprocess.check_call(' '.join(command), shell=True)
+            outmcool = os.path.join(outfolder, '{0}.mcool'.format(out_pre))
+            if append_to is None:
+                newmcool = outmcool
+            else:
+                newmcool = os.path.join(tmpdir, '{0}.new.mcool'.format(out_pre))
+            base = resolutions[0]
+            outcool = os.path.join(tmpdir, '{0}.{1}.cool'.format(out_pre, base))
+            bin_label = ':'.join([out_chroms, str(base)])
+            log.info('Generate contact matrix using cooler at {0} ...'.format(','.join(map(str, resolutions[::-1]))))
+            if binary:
+                pairs_to_cool(pairs_blocks, outcool, chromsizes, base, assembly=out_assembly, tmpdir=tmpdir)
             else:
-                outcool = os.path.join(tmpdir, '{0}.{1}.cool'.format(out_pre, '5kb'))
-                bin_label = ':'.join([out_chroms, str(5000)])
-                log.info('Generate contact matrix using cooler at 2500000,1000000,500000,250000,100000,50000,25000,10000,5000 ...')
                 command = ['cooler', 'cload', 'pairix', '--assembly', out_assembly, '--nproc', str(nproc_out),
                            '--max-split 12', bin_label, out_path, outcool]
                 subprocess.check_call(' '.join(command), shell=True)
-                outmcool = os.path.join(outfolder, '{0}.mcool'.format(out_pre))
-                command = ['cooler', 'zoomify', '-p', str(nproc_out), '-r 5000,10000,25000,50000,100000,250000,500000,1000000,2500000',
-                           '--balance', '-o', outmcool, outcool]
-                subprocess.check_call(' '.join(command), shell=True)
+            zoomify(outcool, newmcool, resolutions, nproc=nproc_out, balance_matrix=balance_matrix and (append_to is None),
+                    tmpdir=tmpdir)
             
             os.remove(outcool)
+            if not append_to is None:
+                log.info('Adding up pixel counts with {0} ...'.format(append_to))
+                merged_mcool = os.path.join(tmpdir, '{0}.merged.mcool'.format(out_pre))
+                merge_mcool(append_to, newmcool, merged_mcool, nproc=nproc_out, balance_matrix=balance_matrix)
+                os.remove(newmcool)
+                command = ['mv', merged_mcool, outmcool]
+                subprocess.check_call(' '.join(command), shell=True)
+            with h5py.File(outmcool, 'r+') as f:
+                f.attrs['HiCLift-manifest'] = json.dumps(manifest)
+        elif hic_writer == 'native':
+            outhic = os.path.join(outfolder, '{0}.hic'.format(out_pre))
+            log.info('Generate contact matrices at {0} ...'.format(','.join(map(str, resolutions[::-1]))))
+            if binary:
+                write_hic_binary(pairs_blocks, outhic, chromsizes, resolutions, genome=out_assembly, nproc=nproc_out)
+            else:
+                write_hic(out_path, outhic, chromsizes, resolutions, genome=out_assembly, nproc=nproc_out)
         else:
             data_folder = os.path.join(os.path.split(HiCLift.__file__)[0], 'data')
             juicer_folder = os.path.join(data_folder, 'juicer_tools_1.11.09_jcuda.0.8.jar')
             outhic = os.path.join(outfolder, '{0}.hic'.format(out_pre))
-            if high_res:
-                command = ['java', '-Xmx'+memory.lower(), '-jar', juicer_folder, 'pre',
-                            '-r 2500000,1000000,500000,250000,100000,50000,25000,10000,5000,2000,1000',
-                            out_path, outhic, out_chroms]
-                log.info('Generate contact matrices using juicer at 2500000,1000000,500000,250000,100000,50000,25000,10000,5000,2000,1000 ...')
-            else:
-                command = ['java', '-Xmx'+memory.lower(), '-jar', juicer_folder, 'pre',
-                            '-r 2500000,1000000,500000,250000,100000,50000,25000,10000,5000',
-                            out_path, outhic, out_chroms]
-                log.info('Generate contact matrices using juicer at 2500000,1000000,500000,250000,100000,50000,25000,10000,5000 ...')
+            res_label = ','.join(map(str, resolutions[::-1]))
+            command = ['java', '-Xmx'+memory.lower(), '-jar', juicer_folder, 'pre',
+                        '-r {0}'.format(res_label), out_path, outhic, out_chroms]
+            log.info('Generate contact matrices using juicer at {0} ...'.format(res_label))
             subprocess.check_call(' '.join(command), shell=True)
 
-        os.remove(out_path)
-        os.remove(out_path+'.px2')
+        if not binary:
+            os.remove(out_path)
+        if indexed:
+            os.remove(out_path+'.px2')
+    
+    if binary:
+        pairs_blocks.remove()
 
     log.info('Done')
\ No newline at end of file